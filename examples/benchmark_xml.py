@@ -0,0 +1,96 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Benchmark: parse and serialize throughput of the XML backends
+for a synthetic artifact batch retrieve payload.
+
+Usage: python benchmark_xml.py [number of artifacts] [repeats]
+"""
+
+import sys
+import time
+from io import BytesIO
+from xml.etree import cElementTree, ElementTree
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+ARTIFACT = """<art:artifact limsid="2-{0}" uri="https://lims.example.com/api/v2/artifacts/2-{0}?state=1">
+<name>Sample {0}</name><type>Analyte</type><output-type>Analyte</output-type>
+<parent-process uri="https://lims.example.com/api/v2/processes/24-1" limsid="24-1"/>
+<qc-flag>PASSED</qc-flag>
+<location><container uri="https://lims.example.com/api/v2/containers/27-1" limsid="27-1"/><value>A:{1}</value></location>
+<working-flag>true</working-flag>
+<sample uri="https://lims.example.com/api/v2/samples/S{0}" limsid="S{0}"/>
+<udf:field type="Numeric" name="Concentration">{0}.5</udf:field>
+<udf:field type="String" name="Comment">Batch benchmark</udf:field>
+</art:artifact>
+"""
+
+
+def payload(count):
+    "Return a batch retrieve response with the given number of artifacts."
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<art:details xmlns:art="http://genologics.com/ri/artifact"'
+             ' xmlns:udf="http://genologics.com/ri/userdefined">\n']
+    for i in xrange(count):
+        parts.append(ARTIFACT.format(i, i % 12 + 1))
+    parts.append('</art:details>\n')
+    return ''.join(parts)
+
+
+def timed(function, repeats):
+    "Return the best time in seconds of the given number of calls."
+    best = None
+    for i in xrange(repeats):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def iterparse(module, data):
+    "Parse the payload incrementally, detaching each entity as get_batch does."
+    root = None
+    depth = 0
+    for event, elem in module.iterparse(BytesIO(data), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                root.remove(elem)
+
+
+def benchmark(name, module, data, repeats):
+    megabytes = len(data) / 1e6
+    tree = module.ElementTree(module.fromstring(data))
+    for label, function in (
+            ('fromstring', lambda: module.fromstring(data)),
+            ('iterparse', lambda: iterparse(module, data)),
+            ('tostring', lambda: module.tostring(tree.getroot(), encoding='UTF-8'))):
+        seconds = timed(function, repeats)
+        print "%-12s %-10s %8.3f s %8.1f MB/s" % (name, label, seconds,
+                                                  megabytes / seconds)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    data = payload(count)
+    print "%i artifacts, %.1f MB" % (count, len(data) / 1e6)
+    benchmark('ElementTree', ElementTree, data, repeats)
+    benchmark('cElementTree', cElementTree, data, repeats)
+    if etree is None:
+        print 'lxml not installed'
+    else:
+        benchmark('lxml', etree, data, repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,3 +29,12 @@ if config.has_section('logging') and config.has_option('logging','MAIN_LOG'):
 	MAIN_LOG = config.get('logging', 'MAIN_LOG').rstrip()
 else:
 	MAIN_LOG = None
+
+# Optional client-side limits on the calls to the LIMS, see genologics.limiter
+# as keyword arguments to Lims; a Lims given none is unlimited
+LIMITS = dict()
+for option, key, get in (('RATE_LIMIT', 'rate_limit', config.getfloat),
+			 ('RATE_BURST', 'rate_burst', config.getint),
+			 ('MAX_IN_FLIGHT', 'max_in_flight', config.getint)):
+	if config.has_option('limits', option):
+		LIMITS[key] = get('limits', option)
@@ -10,8 +10,11 @@ import re
 import urlparse
 import datetime
 import time
-from xml.etree import ElementTree
+import json
 import logging
+from collections import deque
+
+from .xml_backend import ElementTree, register_namespace
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +48,7 @@ _NSMAP = dict(
     wkfcnf='http://genologics.com/ri/workflowconfiguration')
 
 for prefix, uri in _NSMAP.iteritems():
-    ElementTree._namespace_map[uri] = prefix
+    register_namespace(prefix, uri)
 
 _NSPATTERN = re.compile(r'(\{)(.+?)(\})')
 
@@ -61,8 +64,9 @@ class SampleHistory:
     """Class handling the history generation for a given sample/artifact
     AFAIK the only fields of the history that are read are proc.type and outart""" 
 
-    def __init__(self, sample_name=None, output_artifact=None, input_artifact=None, lims=None, pro_per_art=None, test=False):
+    def __init__(self, sample_name=None, output_artifact=None, input_artifact=None, lims=None, pro_per_art=None, test=False, graph=None):
         self.processes_per_artifact=pro_per_art
+        self.graph=graph
         if lims:
             self.lims = lims
             if not (test):
@@ -109,9 +113,10 @@ class SampleHistory:
         samp_art_map ={}
         if self.sample_name:
             artifacts = self.lims.get_artifacts(sample_name = self.sample_name, type = 'Analyte', resolve=True) 
+            input_arts = dict((a.id, a.input_artifact_list()) for a in artifacts)
+            self.lims.get_batch(list(set(i for ins in input_arts.values() for i in ins)))
             for one_art in artifacts:
-                input_arts = one_art.input_artifact_list()
-                for input_art in input_arts:
+                for input_art in input_arts[one_art.id]:
                     for samp in input_art.samples:
                         if samp.name == self.sample_name:
                             samp_art_map[one_art.id] = (one_art.parent_process, input_art.id)
@@ -119,77 +124,16 @@ class SampleHistory:
         self.art_map=samp_art_map
     def alternate_history(self, out_art, in_art=None):
         """This is a try at another way to generate the history.
-        This one iterates over Artifact.parent_process and Process.all_inputs()
-        Then, it takes all the child processes for each input (because we want
-        qc processes too) and puts everything in a dictionnary. 
+        It walks a GenealogyGraph of the sample from the output artifact
+        back through Artifact.parent_process, and takes all the child
+        processes for each input (because we want qc processes too), 
+        putting everything in a dictionnary.
         """
-        history = {}
-        hist_list = []
-       #getting the list of all expected analytes.
-        artifacts = self.lims.get_artifacts(sample_name = self.sample_name, type = 'Analyte', resolve=True)
-        processes=[]
-        inputs=[]
-        if in_art:
-            #If theres an input artifact given, I need to make a loop for this one, before treating it as an output
-            starting_art=in_art
-            inputs.append(in_art)
-            history[in_art]={}
-            #If there is a loacl map, use it. else, query the lims.
-            if self.processes_per_artifact and in_art in self.processes_per_artifact:
-                valid_pcs=self.processes_per_artifact[in_art]
-            else:
-                valid_pcs=self.lims.get_processes(inputartifactlimsid=in_art)
-
-            for tempProcess in valid_pcs:
-                history[in_art][tempProcess.id] = {'date' : tempProcess.date_run,
-                                                   'id' : tempProcess.id,
-                                                   'outart' : (out_art if out_art in [ out.id for out in tempProcess.all_outputs()] else None ),
-                                                   'inart' : in_art,
-                                                   'type' : tempProcess.type.id,
-                                                   'name' : tempProcess.type.name}
-        else:
-            starting_art=out_art
-        #main iteration    
-        #it is quite heavy on logger at info level
-        not_done=True
-        while not_done:
-            logger.info ("looking for "+(starting_art))
-            not_done=False 
-            for o in artifacts:
-                logger.info (o.id)
-                if o.id == starting_art:
-                    if o.parent_process is None:
-                        #flow control : if there is no parent process, we can stop iterating, we're done.
-                        not_done=False
-                        break #breaks the for artifacts, we are done anyway.
-                    else:
-                        not_done=True #keep the loop running
-                    logger.info ("found it")
-                    processes.append(o.parent_process)
-                    logger.info ("looking for inputs of "+o.parent_process.id)
-                    for i in o.parent_process.all_inputs():
-                        logger.info (i.id)
-                        if i in artifacts:
-                            history[i.id]={}
-                            for tempProcess in (self.processes_per_artifact[i.id] if self.processes_per_artifact else self.lims.get_processes(inputartifactlimsid=i.id)):#If there is a loacl map, use it. else, query the lims.
-                                history[i.id][tempProcess.id] = {'date' : tempProcess.date_run,
-                                                               'id' : tempProcess.id,
-                                                               'outart' : (o.id if tempProcess.id == o.parent_process.id else None),
-                                                               'inart' : i.id,
-                                                               'type' : tempProcess.type.id,
-                                                               'name' : tempProcess.type.name}
-
-
-
-                            logger.info ("found input "+i.id)
-                            inputs.append(i.id) #this will be the sorted list of artifacts used to rebuild the history in order
-                            # while increment
-                            starting_art=i.id
-                            
-                            break #break the for allinputs, if we found the right one
-                    break # breaks the for artifacts if we matched the current one
-        self.history=history
-        self.history_list=inputs 
+        graph = self.graph
+        if graph is None or self.sample_name not in graph.sample_artifacts:
+            graph = GenealogyGraph(self.lims, [self.sample_name],
+                                   processes_per_artifact=self.processes_per_artifact)
+        self.history, self.history_list = graph.history(self.sample_name, out_art, in_art)
 
 
     def get_analyte_hist_sorted(self, out_artifact, input_art = None):
@@ -261,6 +205,226 @@ class SampleHistory:
                 history[input_art] = {process.id : step_info}
         return history, input_art
 
+class GenealogyGraph(object):
+    """In-memory genealogy of the artifacts of one or more samples.
+
+    The artifacts, their parent processes and their child processes are
+    loaded with batched calls, and indexed by artifact id so that history,
+    ancestors and descendants queries do not scan or query per step.
+    """
+
+    def __init__(self, lims, sample_names=None, type='Analyte', processes_per_artifact=None):
+        """lims: the Lims instance to load from.
+        sample_names: names of the samples to load the artifacts for.
+        type: artifact type to load, or None for all types.
+        processes_per_artifact: optional map of artifact id to its child
+            processes, used instead of querying the LIMS.
+        """
+        self.lims = lims
+        self.type = type
+        self.artifacts = dict()         # artifact id -> Artifact
+        self.sample_artifacts = dict()  # sample name -> set of artifact ids
+        self.parents = dict()           # artifact id -> parent Process or None
+        self.children = dict()          # artifact id -> list of child Processes
+        self.processes = dict()         # process id -> Process
+        if processes_per_artifact:
+            for art_id, processes in processes_per_artifact.iteritems():
+                self.children[art_id] = list(processes)
+                for process in processes:
+                    self.processes[process.id] = process
+        if sample_names:
+            self.add_samples(sample_names)
+
+    def add_samples(self, sample_names):
+        "Load the artifacts of the given samples, with their parent processes."
+        sample_names = list(sample_names)
+        artifacts = self.lims.get_artifacts(sample_name=sample_names,
+                                            type=self.type, resolve=True)
+        self.add_artifacts(artifacts)
+        for name in sample_names:
+            self.sample_artifacts.setdefault(name, set())
+        if len(sample_names) == 1:
+            self.sample_artifacts[sample_names[0]].update(a.id for a in artifacts)
+        else:
+            self._index_samples(artifacts)
+
+    def add_project(self, projectname):
+        """Load the artifacts of all the samples of the given project,
+        with their parent processes, using batched queries.
+        """
+        samples = self.lims.get_batch(self.lims.get_samples(projectname=projectname))
+        for sample in samples:
+            self.sample_artifacts.setdefault(sample.name, set())
+        if not samples: return
+        artifacts = self.lims.get_artifacts(samplelimsid=[s.id for s in samples],
+                                            type=self.type, resolve=True)
+        self.add_artifacts(artifacts)
+        self._index_samples(artifacts)
+
+    def _index_samples(self, artifacts):
+        "Add the artifacts to the sample_artifacts of their loaded samples."
+        samples = dict()
+        for artifact in artifacts:
+            for node in artifact.root.findall('sample'):
+                sample = Sample(self.lims, uri=node.attrib['uri'])
+                samples.setdefault(sample, []).append(artifact.id)
+        self.lims.get_batch([s for s in samples if s.root is None])
+        for sample, art_ids in samples.iteritems():
+            if sample.name in self.sample_artifacts:
+                self.sample_artifacts[sample.name].update(art_ids)
+
+    def add_artifacts(self, artifacts):
+        "Index the given resolved artifacts and load their parent processes."
+        new = dict()
+        for artifact in artifacts:
+            if artifact.id in self.artifacts: continue
+            self.artifacts[artifact.id] = artifact
+            parent = artifact.parent_process
+            self.parents[artifact.id] = parent
+            if parent is not None and parent.id not in self.processes:
+                new[parent.id] = parent
+        self._add_processes(new.values())
+
+    def _add_processes(self, processes):
+        "Get the processes concurrently, and index them."
+        self.lims._resolve(processes)
+        for process in processes:
+            self.processes[process.id] = process
+
+    def _load_children(self, extra=()):
+        """Load the child processes of all artifacts missing them, and of the
+        extra artifact ids, in one query.
+        """
+        ids = [id for id in self.artifacts if id not in self.children]
+        ids.extend(id for id in extra if id not in self.children and id not in self.artifacts)
+        if not ids: return
+        for id in ids:
+            self.children[id] = []
+        processes = self.lims.get_processes(inputartifactlimsid=ids)
+        self._add_processes([p for p in processes if p.id not in self.processes])
+        for process in processes:
+            for id in process.io_map.by_input:
+                if id in self.children and process not in self.children[id]:
+                    self.children[id].append(process)
+
+    def child_processes(self, art_id):
+        "Return the processes using the given artifact as input."
+        if art_id not in self.children:
+            self._load_children(extra=[art_id])
+        return self.children.get(art_id, [])
+
+    def processes_per_artifact(self):
+        """Return the map of loaded artifact ids to their child processes,
+        as used by SampleHistory.
+        """
+        self._load_children()
+        return dict((id, self.children[id]) for id in self.artifacts)
+
+    def sample_history(self, sample_name, out_art, in_art=None):
+        "Return the SampleHistory of the given output artifact of a sample."
+        return SampleHistory(sample_name=sample_name, output_artifact=out_art,
+                             input_artifact=in_art, lims=self.lims, graph=self)
+
+    def sample_histories(self, output_artifacts):
+        """Return a dictionary of SampleHistory instances by sample name, given
+        a dictionary of output artifact ids by sample name. The histories all
+        share the index of this graph.
+        """
+        self._load_children()
+        result = dict()
+        for sample_name, out_art in output_artifacts.iteritems():
+            result[sample_name] = self.sample_history(sample_name, out_art)
+        return result
+
+    def sample_lineage(self, sample_name, art_id):
+        """Return the chain of (artifact id, parent process, input id) tuples
+        from the given artifact back to the origin of the sample.
+        The input id is None when no input of the sample was found.
+        """
+        members = self.sample_artifacts.get(sample_name, set())
+        result = []
+        seen = set()
+        while art_id in members and art_id not in seen:
+            seen.add(art_id)
+            parent = self.parents.get(art_id)
+            if parent is None: break
+            candidates = [a.id for a in parent.io_map.inputs_per_output(art_id)]
+            candidates.extend(parent.io_map.by_input)
+            input_id = None
+            for id in candidates:
+                if id in members:
+                    input_id = id
+                    break
+            result.append((art_id, parent, input_id))
+            art_id = input_id
+        return result
+
+    def _steps(self, input_id, outart_for):
+        steps = dict()
+        for process in self.child_processes(input_id):
+            steps[process.id] = {'date' : process.date_run,
+                                 'id' : process.id,
+                                 'outart' : outart_for(process),
+                                 'inart' : input_id,
+                                 'type' : process.type.id,
+                                 'name' : process.type.name}
+        return steps
+
+    def history(self, sample_name, out_art, in_art=None):
+        """Return the (history, history_list) of the given output artifact,
+        structured as SampleHistory.history and SampleHistory.history_list.
+        """
+        history = {}
+        hist_list = []
+        if in_art:
+            history[in_art] = self._steps(in_art,
+                lambda p: out_art if out_art in p.io_map.by_output else None)
+            hist_list.append(in_art)
+            start = in_art
+        else:
+            start = out_art
+        for art_id, parent, input_id in self.sample_lineage(sample_name, start):
+            if input_id is None: break
+            history[input_id] = self._steps(input_id,
+                lambda p: art_id if p.id == parent.id else None)
+            hist_list.append(input_id)
+        return history, hist_list
+
+    def ancestors(self, art_id):
+        "Return the ids of the loaded upstream artifacts, nearest first."
+        result = []
+        seen = set([art_id])
+        queue = deque([art_id])
+        while queue:
+            current = queue.popleft()
+            parent = self.parents.get(current)
+            if parent is None: continue
+            for artifact in parent.io_map.inputs_per_output(current):
+                if artifact.id in seen: continue
+                seen.add(artifact.id)
+                result.append(artifact.id)
+                queue.append(artifact.id)
+        return result
+
+    def descendants(self, art_id):
+        """Return the ids of the downstream artifacts, nearest first.
+        Only the outputs of loaded artifacts are followed further.
+        """
+        result = []
+        seen = set([art_id])
+        queue = deque([art_id])
+        while queue:
+            current = queue.popleft()
+            if current != art_id and current not in self.artifacts: continue
+            for process in self.child_processes(current):
+                for artifact in process.io_map.outputs_per_input(current):
+                    if artifact.id in seen: continue
+                    seen.add(artifact.id)
+                    result.append(artifact.id)
+                    queue.append(artifact.id)
+        return result
+
+
 class BaseDescriptor(object):
     "Abstract base descriptor for an instance attribute."
 
@@ -370,6 +534,102 @@ class BooleanDescriptor(StringDescriptor):
             return node.text.lower() == 'true'
 
 
+class UdfType(object):
+    """Conversion between the XML text and the Python value of a UDF type,
+    and validation of the values set for it.
+    """
+
+    def __init__(self, name, parse=None, types=None, format=unicode, error=None):
+        self.name = name
+        self._parse = parse
+        self.types = types
+        self._format = format
+        self.error = error
+
+    def parse(self, text):
+        "Return the Python value of the XML text."
+        if not text:
+            return None
+        elif self._parse is None:
+            return text
+        else:
+            return self._parse(text)
+
+    def format(self, value):
+        "Return the XML text of the value; raise TypeError if invalid."
+        if value is None:
+            return None
+        if self.types is None:
+            raise NotImplementedError("UDF type '%s'" % self.name)
+        if not isinstance(value, self.types):
+            raise TypeError(self.error)
+        value = self._format(value)
+        if not isinstance(value, unicode):
+            value = unicode(value, 'UTF-8')
+        return value
+
+
+def _parse_numeric(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def _format_string(value):
+    return value
+
+_UDF_TYPES = dict()
+for _udf_type in [
+        UdfType('String', types=basestring, format=_format_string,
+                error='String UDF requires str or unicode value'),
+        UdfType('Str', types=basestring, format=_format_string,
+                error='String UDF requires str or unicode value'),
+        UdfType('Text', types=basestring, format=_format_string,
+                error='Text UDF requires str or unicode value'),
+        UdfType('Numeric', parse=_parse_numeric, types=(int, float), format=str,
+                error='Numeric UDF requires int or float value'),
+        UdfType('Boolean', parse=lambda text: text == 'true', types=bool,
+                format=lambda value: value and 'True' or 'False',
+                error='Boolean UDF requires bool value'),
+        UdfType('Date', types=datetime.date, format=str, # Too restrictive?
+                parse=lambda text: datetime.date(*time.strptime(text, "%Y-%m-%d")[:3]),
+                error='Date UDF requires datetime.date value'),
+        UdfType('URI', types=basestring, format=str,
+                error='URI UDF requires str or punycode (unicode) value')]:
+    _UDF_TYPES[_udf_type.name.lower()] = _udf_type
+
+def get_udf_type(name):
+    """Return the UdfType for the type name given in the XML.
+    Unknown types yield a UdfType that keeps the text, and cannot be set.
+    """
+    try:
+        return _UDF_TYPES[name]
+    except KeyError:
+        udf_type = _UDF_TYPES.get(name.lower())
+        if udf_type is None:
+            udf_type = UdfType(name)
+        _UDF_TYPES[name] = udf_type
+        return udf_type
+
+
+class UdfSchema(object):
+    """The types of the UDFs configured in the LIMS, with their UdfType,
+    keyed by (attach-to category, attach-to name) and UDF name.
+    Built by Lims.load_udf_schema from the Udfconfig entities.
+    """
+
+    def __init__(self):
+        self.fields = dict()
+
+    def add(self, attach_to_category, attach_to_name, name, type):
+        key = (attach_to_category or '', attach_to_name)
+        self.fields.setdefault(key, dict())[name] = get_udf_type(type)
+
+    def get_types(self, attach_to_category, attach_to_name):
+        "Return the dictionary of UdfType by UDF name for the attach-to key."
+        return self.fields.get((attach_to_category or '', attach_to_name), dict())
+
+
 class UdfDictionary(object):
     "Dictionary-like container of UDFs, optionally within a UDT."
 
@@ -377,6 +637,7 @@ class UdfDictionary(object):
         self.instance = instance
         self._udt = udt
         self._update_elems()
+        self._prepare_types()
         self._prepare_lookup()
         self.location=0
 
@@ -410,23 +671,25 @@ class UdfDictionary(object):
                 if elem.tag == tag:
                     self._elems.append(elem)
 
+    def _prepare_types(self):
+        "Get the UdfType of the configured UDFs, if the LIMS has a UdfSchema."
+        self._types = dict()
+        schema = getattr(self.instance.lims, 'udf_schema', None)
+        if schema is not None and not self._udt:
+            attach_to = self.instance._udf_attach_to()
+            if attach_to is not None:
+                self._types = schema.get_types(*attach_to)
+
+    def _get_type(self, elem):
+        try:
+            return self._types[elem.attrib['name']]
+        except KeyError:
+            return get_udf_type(elem.attrib['type'])
+
     def _prepare_lookup(self):
         self._lookup = dict()
         for elem in self._elems:
-            type = elem.attrib['type'].lower()
-            value = elem.text
-            if not value:
-                value = None
-            elif type == 'numeric':
-                try:
-                    value = int(value)
-                except ValueError:
-                    value = float(value)
-            elif type == 'boolean':
-                value = value == 'true'
-            elif type == 'date':
-                value = datetime.date(*time.strptime(value, "%Y-%m-%d")[:3])
-            self._lookup[elem.attrib['name']] = value
+            self._lookup[elem.attrib['name']] = self._get_type(elem).parse(elem.text)
 
     def __contains__(self,key):
         try:
@@ -442,43 +705,14 @@ class UdfDictionary(object):
         self._lookup[key] = value
         for node in self._elems:
             if node.attrib['name'] != key: continue
-            type = node.attrib['type'].lower()
-
-            if value is None:
-                pass
-            elif type == 'string':
-                if not isinstance(value, basestring):
-                    raise TypeError('String UDF requires str or unicode value')
-            elif type == 'str':
-                if not isinstance(value, basestring):
-                    raise TypeError('String UDF requires str or unicode value')
-            elif type == 'text':
-                if not isinstance(value, basestring):
-                    raise TypeError('Text UDF requires str or unicode value')
-            elif type == 'numeric':
-                if not isinstance(value, (int, float)):
-                    raise TypeError('Numeric UDF requires int or float value')
-                value = str(value)
-            elif type == 'boolean':
-                if not isinstance(value, bool):
-                    raise TypeError('Boolean UDF requires bool value')
-                value = value and 'True' or 'False'
-            elif type == 'date':
-                if not isinstance(value, datetime.date): # Too restrictive?
-                    raise TypeError('Date UDF requires datetime.date value')
-                value = str(value)
-            elif type == 'uri':
-                if not isinstance(value, basestring):
-                    raise TypeError('URI UDF requires str or punycode (unicode) value')
-                value = str(value)
-            else:
-                raise NotImplemented("UDF type '%s'" % type)
-            if not isinstance(value, unicode):
-                value = unicode(value, 'UTF-8')
-            node.text = value
+            node.text = self._get_type(node).format(value)
             break
-        else:                           # Create new entry; heuristics for type
-            if isinstance(value, basestring):
+        else:                           # Create new entry; configured type or heuristics
+            if key in self._types:
+                udf_type = self._types[key]
+                type = udf_type.name
+                value = udf_type.format(value)
+            elif isinstance(value, basestring):
                 type = '\n' in value and 'Text' or 'String'
             elif isinstance(value, (int, float)):
                 type = 'Numeric'
@@ -490,7 +724,7 @@ class UdfDictionary(object):
                 value = str(value)
             else:
                 raise NotImplementedError("Cannot handle value of type '%s'"
-                                          " for UDF" % type(value))
+                                          " for UDF" % value.__class__.__name__)
             if self._udt:
                 root = self.instance.root.find(nsmap('udf:type'))
             else:
@@ -499,7 +733,7 @@ class UdfDictionary(object):
                                           nsmap('udf:field'),
                                           type=type,
                                           name=key)
-            if not isinstance(value, unicode):
+            if value is not None and not isinstance(value, unicode):
                 value = unicode(str(value), 'UTF-8')
             elem.text = value
 
@@ -703,21 +937,73 @@ class ReagentLabelList(BaseDescriptor):
 		pass
 	return self.value
 
-class InputOutputMapList(BaseDescriptor):
-    """An instance attribute yielding a list of tuples (input, output)
-    where each item is a dictionary, representing the input/output
-    maps of a Process instance.
+class EscalationDescriptor(TagDescriptor):
+    """An instance attribute yielding a dictionary describing the
+    escalation of a step, with the escalated artifacts retrieved
+    in one batch call.
     """
 
     def __get__(self, instance, cls):
         instance.get()
-        self.value = []
-        for node in instance.root.findall('input-output-map'):
-            input = self.get_dict(instance.lims, node.find('input'))
-            output = self.get_dict(instance.lims, node.find('output'))
-            self.value.append((input, output))
+        lims = instance.lims
+        self.value = dict()
+        artifacts = []
+        for node in instance.root.findall(self.tag):
+            self.value['artifacts'] = artifacts
+            request = node.find('request')
+            self.value['author'] = Researcher(lims, uri=request.find('author').attrib.get('uri'))
+            self.value['request'] = request.find('comment').text
+            review = node.find('review')
+            if review is not None: #recommended by the Etree doc
+                self.value['status'] = 'Reviewed'
+                self.value['reviewer'] = Researcher(lims, uri=review.find('author').attrib.get('uri'))
+                self.value['answer'] = review.find('comment').text
+            else:
+                self.value['status'] = 'Pending'
+            for node2 in node.findall('escalated-artifacts'):
+                artifacts.extend(Artifact(lims, uri=ch.attrib.get('uri')) for ch in node2)
+        lims.get_batch([a for a in artifacts if a.root is None])
         return self.value
 
+
+class IndexSequenceDescriptor(BaseDescriptor):
+    """An instance attribute yielding the sequence of the Index
+    special type of a reagent type, or None.
+    """
+
+    def __get__(self, instance, cls):
+        instance.get()
+        for node in instance.root.findall('special-type'):
+            if node.attrib.get('name') == 'Index':
+                for child in node.findall('attribute'):
+                    if child.attrib.get('name') == 'Sequence':
+                        return child.attrib.get('value')
+        return None
+
+
+class IOMap(object):
+    """Indexed input/output maps of a Process instance.
+    The (input, output) tuples are parsed once, and indexed by input LIMS id,
+    output LIMS id and output type for constant-time lookups.
+    """
+
+    def __init__(self, lims, root):
+        self.maps = []
+        self.by_input = dict()
+        self.by_output = dict()
+        self.by_output_type = dict()
+        for node in root.findall('input-output-map'):
+            input = self.get_dict(lims, node.find('input'))
+            output = self.get_dict(lims, node.find('output'))
+            io = (input, output)
+            self.maps.append(io)
+            if input is not None:
+                self.by_input.setdefault(input.get('limsid'), []).append(io)
+            if output is not None:
+                self.by_output.setdefault(output.get('limsid'), []).append(io)
+                self.by_output_type.setdefault(output.get('output-type'),
+                                               []).append(io)
+
     def get_dict(self, lims, node):
         if node is None: return None
         result = dict()
@@ -726,16 +1012,72 @@ class InputOutputMapList(BaseDescriptor):
                 result[key] = node.attrib[key]
             except KeyError:
                 pass
-            for uri in ['uri', 'post-process-uri']:
-                try:
-                    result[uri] = Artifact(lims, uri=node.attrib[uri])
-                except KeyError:
-                    pass
+        for uri in ['uri', 'post-process-uri']:
+            try:
+                result[uri] = Artifact(lims, uri=node.attrib[uri])
+            except KeyError:
+                pass
         node = node.find('parent-process')
         if node is not None:
             result['parent-process'] = Process(lims, node.attrib['uri'])
         return result
 
+    def outputs_per_input(self, limsid, output_type=None):
+        "Return the output artifacts produced from the given input LIMS id."
+        result = []
+        for input, output in self.by_input.get(limsid, []):
+            if output is None: continue
+            if output_type and output.get('output-type') != output_type:
+                continue
+            result.append(output['uri'])
+        return result
+
+    def inputs_per_output(self, limsid):
+        "Return the input artifacts used to produce the given output LIMS id."
+        return [io[0]['uri'] for io in self.by_output.get(limsid, [])
+                if io[0] is not None]
+
+    def input_ids(self):
+        "Return the LIMS ids of all inputs, in map order."
+        return [io[0]['limsid'] for io in self.maps]
+
+    def output_ids(self, output_type=None):
+        """Return the LIMS ids of all outputs, or of the outputs of the
+        given output type, in map order."""
+        if output_type is None:
+            maps = self.maps
+        else:
+            maps = self.by_output_type.get(output_type, [])
+        return [io[1]['limsid'] for io in maps if io[1] is not None]
+
+
+class IOMapDescriptor(BaseDescriptor):
+    """An instance attribute yielding the IOMap of a Process instance.
+    The IOMap is cached on the instance until its XML root is replaced.
+    """
+
+    def __get__(self, instance, cls):
+        instance.get()
+        try:
+            if instance._io_map_root is instance.root:
+                return instance._io_map
+        except AttributeError:
+            pass
+        instance._io_map = IOMap(instance.lims, instance.root)
+        instance._io_map_root = instance.root
+        return instance._io_map
+
+
+class InputOutputMapList(IOMapDescriptor):
+    """An instance attribute yielding a list of tuples (input, output)
+    where each item is a dictionary, representing the input/output
+    maps of a Process instance.
+    """
+
+    def __get__(self, instance, cls):
+        self.value = list(super(InputOutputMapList, self).__get__(instance, cls).maps)
+        return self.value
+
 
 class Entity(object):
     "Base class for the entities in the LIMS database."
@@ -750,20 +1092,20 @@ class Entity(object):
             else:
                 uri = lims.get_uri(cls._URI, id)
 
-        try:
-            return lims.cache[uri]
-        except KeyError:
-            return object.__new__(cls)
+        # Threads creating the same entity at once must get one instance
+        with lims.cache_lock:
+            try:
+                return lims.cache[uri]
+            except KeyError:
+                instance = object.__new__(cls)
+                instance.lims = lims
+                instance._uri = uri
+                instance.root = None
+                lims.cache[uri] = instance
+                return instance
 
     def __init__(self, lims, uri=None, id=None):
         assert uri or id
-        if hasattr(self, 'lims'): return
-        if not uri:
-            uri = lims.get_uri(self._URI, id)
-        lims.cache[uri] = self
-        self.lims = lims
-        self._uri = uri
-        self.root = None
 
     def __str__(self):
         return "%s(%s)" % (self.__class__.__name__, self.id)
@@ -785,9 +1127,15 @@ class Entity(object):
         return parts.path.split('/')[-1]
 
     def get(self, force=False):
-        "Get the XML data for this instance."
+        """Get the XML data for this instance. Concurrent calls share
+        a single request and parse, unless forced."""
         if not force and self.root is not None: return
-        self.root = self.lims.get(self.uri)
+        self.root = self.lims.get_shared(self.uri, instance=self, force=force)
+
+    def _udf_attach_to(self):
+        """Return the (attach-to category, attach-to name) key of the UDFs
+        of this instance in the UdfSchema, or None if unknown."""
+        return ('', self.__class__.__name__)
 
     def put(self):
         "Save this instance by doing PUT of its serialized XML."
@@ -932,6 +1280,7 @@ class Udfconfig(Entity):
     _URI = 'configuration/udfs'
 
     name = StringDescriptor('name')
+    type = StringAttributeDescriptor('type')
     attach_to_name = StringDescriptor('attach-to-name')
     attach_to_category = StringDescriptor('attach-to-category')
 
@@ -946,24 +1295,34 @@ class Process(Entity):
     technician    = EntityDescriptor('technician', Researcher)
     protocol_name = StringDescriptor('protocol-name')
     input_output_maps = InputOutputMapList()
+    io_map         = IOMapDescriptor()
     udf            = UdfDictionaryDescriptor()
     udt            = UdtDictionaryDescriptor()
     files          = EntityListDescriptor(nsmap('file:file'), File)
     # instrument XXX
     # process_parameters XXX
 
+    def _udf_attach_to(self):
+        # Avoid retrieving the process type only to look up the UDF types
+        type = self.type
+        if type is None or type.root is None:
+            return None
+        return ('ProcessType', type.name)
+
     def outputs_per_input(self, inart, ResultFile = False, SharedResultFile = False,  Analyte = False):
         """Getting all the output artifacts related to a particual input artifact"""
-        
-        inouts = filter(lambda io: io[0]['limsid'] == inart, self.input_output_maps)
+        output_type = None
         if ResultFile:
-            inouts = filter(lambda io: io[1]['output-type'] == 'ResultFile', inouts)
+            output_type = 'ResultFile'
         elif SharedResultFile:
-            inouts = filter(lambda io: io[1]['output-type'] == 'SharedResultFile', inouts)
+            output_type = 'SharedResultFile'
         elif Analyte:
-            inouts = filter(lambda io: io[1]['output-type'] == 'Analyte', inouts)
-        outs = map(lambda io: io[1]['uri'], inouts)
-        return outs
+            output_type = 'Analyte'
+        return self.io_map.outputs_per_input(inart, output_type=output_type)
+
+    def inputs_per_output(self, outart):
+        """Getting all the input artifacts related to a particular output artifact"""
+        return self.io_map.inputs_per_output(outart)
 
     def input_per_sample(self, sample):
         """gettiung all the input artifacts dereved from the specifyed sample"""
@@ -975,45 +1334,88 @@ class Process(Entity):
                     ins.append(inp)
         return ins
     
-    def all_inputs(self,unique=True, resolve=True):
-        """Retrieving all input artifacts from input_output_maps
-        if unique is true, no duplicates are returned.
+    def _memoized(self, key, compute):
+        """Return the value memoized under key, computing it if missing.
+        The memo is dropped whenever the XML root of the process changes.
         """
-        #if the process has no input, that is not standard and we want to know about it
+        self.get()
+        if getattr(self, '_memo_root', None) is not self.root:
+            self._memo = dict()
+            self._memo_root = self.root
         try:
-            ids = [io[0]['limsid'] for io in self.input_output_maps]
-        except TypeError:
-            logger.error("Process ",self," has no input artifacts")
-            raise TypeError
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = compute()
+            return value
+
+    def refresh(self):
+        """Re-read the process XML and drop the memoized artifact lists."""
+        self._memo_root = None
+        self.get(force=True)
+
+    def _get_artifacts(self, ids, unique, resolve):
         if unique:
             ids = list(frozenset(ids))
+        artifacts = [Artifact(self.lims,id=id) for id in ids if id is not None]
         if resolve:
-            return self.lims.get_batch([Artifact(self.lims,id=id) for id in ids if id is not None])
+            return self.lims.get_batch(artifacts)
         else:
-            return [Artifact(self.lims,id=id) for id in ids if id is not None]
+            return artifacts
+
+    def all_inputs(self,unique=True, resolve=True):
+        """Retrieving all input artifacts from input_output_maps
+        if unique is true, no duplicates are returned.
+        """
+        def compute():
+            #if the process has no input, that is not standard and we want to know about it
+            try:
+                ids = self.io_map.input_ids()
+            except TypeError:
+                logger.error("Process ",self," has no input artifacts")
+                raise TypeError
+            return self._get_artifacts(ids, unique, resolve)
+        return list(self._memoized(('inputs', unique, resolve), compute))
 
     def all_outputs(self,unique=True, resolve=True):
         """Retrieving all output artifacts from input_output_maps
         if unique is true, no duplicates are returned.
         """
-        #Given how ids is structured, io[1] might be None : some process don't have an output.
-        ids = [io[1]['limsid'] for io in self.input_output_maps if io[1] is not None]
-        if unique:
-            ids = list(frozenset(ids))
-        if resolve:
-            return  self.lims.get_batch([Artifact(self.lims,id=id) for id in ids if id is not None])
-        else:
-            return  [Artifact(self.lims,id=id) for id in ids if id is not None]
+        def compute():
+            #Given how ids is structured, io[1] might be None : some process don't have an output.
+            return self._get_artifacts(self.io_map.output_ids(), unique, resolve)
+        return list(self._memoized(('outputs', unique, resolve), compute))
+
+    def _partition(self, key, artifacts, attr):
+        "Return the memoized partition of the artifacts by the attribute."
+        def compute():
+            result = dict()
+            for artifact in artifacts():
+                result.setdefault(getattr(artifact, attr), []).append(artifact)
+            return result
+        return self._memoized(key, compute)
+
+    def _outputs_by(self, attr):
+        return self._partition(('outputs_by', attr),
+                               lambda: self.all_outputs(unique=True), attr)
+
+    def _inputs_by(self, attr):
+        return self._partition(('inputs_by', attr),
+                               lambda: self.all_inputs(unique=True), attr)
+
+    def _outputs_of_type(self, output_type):
+        "Return the memoized unique outputs of the output type, resolved."
+        def compute():
+            ids = self.io_map.output_ids(output_type)
+            return self._get_artifacts(ids, True, True)
+        return list(self._memoized(('outputs_of_type', output_type), compute))
 
     def shared_result_files(self):
         """Retreve all resultfiles of output-generation-type PerAllInputs."""
-        artifacts = self.all_outputs(unique=True)
-        return filter(lambda a: a.output_type == 'SharedResultFile', artifacts)
+        return self._outputs_of_type('SharedResultFile')
 
     def result_files(self):
         """Retreve all resultfiles of output-generation-type perInput."""
-        artifacts = self.all_outputs(unique=True)
-        return filter(lambda a: a.output_type == 'ResultFile', artifacts)
+        return self._outputs_of_type('ResultFile')
 
     def analytes(self):
         """Retreving the output Analytes of the process, if existing. 
@@ -1021,11 +1423,9 @@ class Process(Entity):
         analytes are returned. Input/Output is returned as a information string.
         Makes aggregate processes and normal processes look the same."""
         info = 'Output'
-        artifacts = self.all_outputs(unique=True)
-        analytes = filter(lambda a: a.type == 'Analyte', artifacts)
+        analytes = list(self._outputs_by('type').get('Analyte', []))
         if len(analytes) == 0:
-            artifacts = self.all_inputs(unique=True)
-            analytes = filter(lambda a: a.type == 'Analyte', artifacts)
+            analytes = list(self._inputs_by('type').get('Analyte', []))
             info = 'Input'
         return analytes, info
 
@@ -1035,11 +1435,13 @@ class Process(Entity):
 
     def output_containers(self):
         """Retrieve all unique output containers"""
-        cs = []
-        for o_a in self.all_outputs(unique=True):
-            if o_a.container:
-                cs.append(o_a.container)
-        return list(frozenset(cs))
+        def compute():
+            cs = []
+            for o_a in self.all_outputs(unique=True):
+                if o_a.container:
+                    cs.append(o_a.container)
+            return list(frozenset(cs))
+        return list(self._memoized('output_containers', compute))
 
 class Artifact(Entity):
     "Any process input or output; analyte or file."
@@ -1063,15 +1465,25 @@ class Artifact(Entity):
     # artifact_groups XXX
 
     def input_artifact_list(self):
-        """Returns the input artifact ids of the parrent process."""
-        input_artifact_list=[]
-        try:
-            for tuple in self.parent_process.input_output_maps:
-                if tuple[1]['limsid'] == self.id:
-                    input_artifact_list.append(tuple[0]['uri'])#['limsid'])
-        except:
-            pass
-        return input_artifact_list
+        """Returns the input artifacts of the parrent process, from the
+        output->inputs index the process shares with all its outputs."""
+        parent = self.parent_process
+        if parent is None:
+            return []
+        return parent.inputs_per_output(self.id)
+
+    def _udf_attach_to(self):
+        return ('', self.type)
+
+    @property
+    def reagent_sequences(self):
+        """The index sequences of the reagent labels, looked up in the
+        ReagentIndex if built, or else in one for these labels only."""
+        labels = self.reagent_labels
+        index = self.lims._reagent_index
+        if index is None:
+            index = self.lims.get_reagent_index(names=labels)
+        return [index.sequence(name) for name in labels]
 
     def get_state(self):
         "Parse out the state value from the URI."
@@ -1107,25 +1519,7 @@ class StepActions(Entity):
     """Small hack to be able to query the actions subentity of
     the Step entity. Right now, only the escalation is parsed."""
 
-    def __init__(self, lims, uri=None, id=None):
-        self.lims=lims
-        self.uri="{0}/actions".format(uri)
-        self.root=lims.get(self.uri)
-        self.escalation={}
-        for node in self.root.findall('escalation'):
-            self.escalation['artifacts']=[]
-            self.escalation['author']=Researcher(lims,uri=node.find('request').find('author').attrib.get('uri'))
-            self.escalation['request']=uri=node.find('request').find('comment').text
-            if node.find('review') is not None: #recommended by the Etree doc
-                self.escalation['status']='Reviewed'
-                self.escalation['reviewer']= Researcher(lims,uri=node.find('review').find('author').attrib.get('uri'))
-                self.escalation['answer']=uri=node.find('review').find('comment').text
-            else:
-                self.escalation['status']='Pending'
-
-            for node2 in node.findall('escalated-artifacts'):
-                art= lims.get_batch([Artifact(lims,uri=ch.attrib.get('uri')) for ch in node2])
-                self.escalation['artifacts'].extend(art)
+    escalation = EscalationDescriptor('escalation')
 
 
 class Step(Entity):
@@ -1133,11 +1527,10 @@ class Step(Entity):
 
     _URI = 'steps'
 
-    def __init__(self, lims, uri=None, id=None):
-        super(Step, self).__init__(lims,uri,id)
-        assert self.uri is not None
-        self.actions= StepActions(lims,uri=self.uri)
-
+    @property
+    def actions(self):
+        "The actions subentity; not retrieved until one of its fields is read."
+        return StepActions(self.lims, uri="{0}/actions".format(self.uri))
 
     #placements         = EntityDescriptor('placements', StepPlacements)
     #program_status     = EntityDescriptor('program-status',StepProgramStatus)
@@ -1185,18 +1578,70 @@ class ReagentType(Entity):
     _URI="reagenttypes"
     _TAG="reagent-type"
 
+    name=StringAttributeDescriptor('name')
     category=StringDescriptor('reagent-category')
+    sequence=IndexSequenceDescriptor()
 
-    def __init__(self, lims, uri=None, id=None):
-        super(ReagentType, self).__init__(lims,uri,id)
-        assert self.uri is not None
-        self.root=lims.get(self.uri)
-        self.sequence=None
-        for t in self.root.findall('special-type'):
-            if t.attrib.get("name") == "Index":
-                for child in t.findall("attribute"):
-                    if child.attrib.get("name") == "Sequence":
-                        self.sequence=child.attrib.get("value")
+
+class ReagentIndex(object):
+    """Lookup table between reagent type (label) names and index sequences.
+    Built by Lims.get_reagent_index, and optionally stored in a JSON file.
+    """
+
+    FILE_VERSION = 1
+
+    def __init__(self, sequences=dict()):
+        self.sequences = dict()   # name -> sequence
+        self.names = dict()       # sequence -> name
+        for name, sequence in sequences.iteritems():
+            self.add(name, sequence)
+
+    def add(self, name, sequence):
+        self.sequences[name] = sequence
+        if sequence is not None:
+            self.names[sequence] = name
+
+    def sequence(self, name):
+        "Return the index sequence of the given reagent label name, or None."
+        return self.sequences.get(name)
+
+    def name(self, sequence):
+        "Return the reagent label name of the given index sequence, or None."
+        return self.names.get(sequence)
+
+    def __contains__(self, name):
+        return name in self.sequences
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def write(self, path, baseuri=None):
+        "Write the index to the given file, recording the server's base URI."
+        data = dict(version=self.FILE_VERSION,
+                    created=time.time(),
+                    baseuri=baseuri,
+                    sequences=self.sequences)
+        with open(path, 'w') as outfile:
+            json.dump(data, outfile)
+
+    @staticmethod
+    def read(path, max_age=None, baseuri=None):
+        """Read an index from the given file. Return None if the file is
+        missing, unreadable, of another version, for another server than
+        baseuri, or older than max_age seconds.
+        """
+        try:
+            with open(path) as infile:
+                data = json.load(infile)
+        except (IOError, ValueError):
+            return None
+        if data.get('version') != ReagentIndex.FILE_VERSION:
+            return None
+        if data.get('baseuri') != baseuri:
+            return None
+        if max_age is not None and time.time() - data.get('created', 0) > max_age:
+            return None
+        return ReagentIndex(data['sequences'])
 
 Sample.artifact          = EntityDescriptor('artifact', Artifact)
 StepActions.step         = EntityDescriptor('step', Step)
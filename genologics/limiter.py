@@ -0,0 +1,86 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Client-side limits on the calls made to the LIMS server.
+"""
+
+import time
+import threading
+
+
+class Limiter(object):
+    """Token-bucket rate limiter and bound on the number of calls in flight.
+
+    Calls are admitted at a sustained rate of at most rate per second,
+    with bursts of up to burst calls, and with at most max_in_flight
+    calls in progress; None disables the corresponding limit.
+    Waiting calls of a more urgent priority class are admitted first:
+    a BULK call waits for as long as INTERACTIVE calls are waiting.
+    """
+
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.max_in_flight = max_in_flight
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.in_flight = 0
+        self.waiting = [0, 0]
+        # Calls delayed and total seconds waited
+        self.stats = dict(calls=0, delayed=0, wait=0.0)
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=INTERACTIVE, deadline=None):
+        """Wait until a call of the priority class may start.
+        Return False if the time given by deadline passes first.
+        """
+        start = time.time()
+        with self._condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    timeout = None
+                    if not any(self.waiting[:priority]) and \
+                       (self.max_in_flight is None or self.in_flight < self.max_in_flight):
+                        timeout = self._take()
+                        if timeout is None:
+                            self.in_flight += 1
+                            self._count(time.time() - start)
+                            return True
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                    self._condition.wait(timeout)
+            finally:
+                self.waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def release(self):
+        "Record the end of a call admitted by acquire."
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _take(self):
+        """Take a token from the bucket and return None, or return the
+        seconds until one is available.
+        """
+        if self.rate is None:
+            return None
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+    def _count(self, wait):
+        self.stats['calls'] += 1
+        if wait > 0.001:
+            self.stats['delayed'] += 1
+            self.stats['wait'] += wait
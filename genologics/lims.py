@@ -8,40 +8,243 @@ Copyright (C) 2012 Per Kraulis
 
 __all__ = ['Lab', 'Researcher', 'Project', 'Sample',
            'Containertype', 'Container', 'Processtype', 'Process',
-           'Artifact', 'Lims']
+           'Artifact', 'Lims', 'Query']
 
+import os
+import re
 import urllib
-from cStringIO import StringIO
+import itertools
+import json
+import sys
+import time
+import random
+import email.utils
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 # http://docs.python-requests.org/
 import requests
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 from .entities import *
+from . import xml_backend
+from .limiter import Limiter
+
+logger = logging.getLogger(__name__)
+
+
+class Query(object):
+    """Lazy query for the instances of an entity class. Filters accumulate
+    in new Query objects, and nothing is fetched until the query is
+    iterated, sliced, counted or resolved.
+    """
+
+    def __init__(self, lims, klass, params=dict()):
+        self.lims = lims
+        self.klass = klass
+        self.params = dict(params)
+
+    def __repr__(self):
+        return "Query(%s, %s)" % (self.klass.__name__, self.params)
+
+    def filter(self, udf=dict(), udtname=None, udt=dict(), **kwargs):
+        """Return a new Query with the filters added; the keyword arguments
+        are those of the corresponding get_* method of Lims.
+        """
+        params = dict(self.params)
+        params.update(self.lims._get_params(**kwargs))
+        params.update(self.lims._get_params_udf(udf=udf, udtname=udtname, udt=udt))
+        return Query(self.lims, self.klass, params)
+
+    def since(self, last_modified):
+        "Return a new Query for the instances modified since the ISO datetime."
+        return self.filter(last_modified=last_modified)
+
+    def __iter__(self):
+        "Stream the instances, fetching one page at a time."
+        seen = set()
+        for params in self.lims._split_params(self.klass, self.params):
+            for page in self.lims._iter_pages(self.klass, params=params, follow=True):
+                for instance in page:
+                    if instance.uri in seen: continue
+                    seen.add(instance.uri)
+                    yield instance
+
+    def _iter_from(self, start):
+        if len(self.lims._split_params(self.klass, self.params)) > 1:
+            # Offsets do not carry over between chunks
+            return itertools.islice(iter(self), start, None)
+        return self._iter_params_from(start)
+
+    def _iter_params_from(self, start):
+        params = dict(self.params)
+        params['start-index'] = int(params.get('start-index', 0)) + start
+        for page in self.lims._iter_pages(self.klass, params=params, follow=True):
+            for instance in page:
+                yield instance
+
+    def __getitem__(self, key):
+        """Get the instance at an index, or the list of instances in a slice,
+        starting the listing at that index with 'start-index'.
+        """
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise ValueError('slice step not supported')
+            start = key.start or 0
+            if start < 0 or (key.stop is not None and key.stop < 0):
+                raise ValueError('negative indices not supported')
+            if key.stop is not None and key.stop <= start:
+                return []
+            result = []
+            for instance in self._iter_from(start):
+                result.append(instance)
+                if key.stop is not None and start + len(result) >= key.stop: break
+            return result
+        if key < 0:
+            raise IndexError('negative indices not supported')
+        for instance in self._iter_from(key):
+            return instance
+        raise IndexError('query index out of range')
+
+    def count(self):
+        "Get the number of matching instances, without creating them."
+        return self.lims._count(self.klass, self.params)
+
+    def first(self):
+        "Get the first matching instance, or None."
+        return self.lims._first(self.klass, self.params)
+
+    def exists(self):
+        return self.first() is not None
+
+    def resolve(self):
+        "Get the list of matching instances, with their content retrieved."
+        result = list(self)
+        self.lims._resolve(result)
+        return result
+
+
+class _CountingReader(object):
+    """File-like wrapper counting the bytes read from the file, and raising
+    the errors of a dropped connection as requests does."""
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def read(self, *args):
+        try:
+            data = self.file.read(*args)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e)
+        self.count += len(data)
+        return data
+
+
+class _Flight(object):
+    "A GET in progress, whose result or error is shared by its callers."
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 class Lims(object):
     "LIMS interface through which all entity instances are retrieved."
 
     VERSION = 'v2'
+    # Longest query URL sent; longer list-valued queries are split up
+    MAX_URL_LENGTH = 4000
+    # Configuration entities stored by load_config_snapshot
+    CONFIG_CLASSES = (Processtype, Containertype, Udfconfig, Protocol,
+                      ProtocolStep, Workflow, Stage)
+    CONFIG_SNAPSHOT_VERSION = 1
+    # Number of threads for concurrent requests
+    WORKERS = 8
+    # Number of threads parsing large batch responses, in chunks of
+    # about PARSE_CHUNK_SIZE bytes; 1 parses the response as it streams.
+    # Only lxml parses without holding the GIL, so other XML backends
+    # always parse as the response streams.
+    PARSE_WORKERS = 1
+    PARSE_CHUNK_SIZE = 1024 * 1024
+    # Content encodings accepted for responses
+    ACCEPT_ENCODING = 'gzip, deflate'
+    # Number of calls kept in the transfers log
+    TRANSFERS_SIZE = 1000
+    # Connections kept open per host, for http and https alike
+    POOL_SIZE = 100
+    # Seconds to wait for a connection, and for data once connected
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 300
+    # Retries of GETs, PUTs and batch retrievals on dropped connections or
+    # these statuses, after exponentially growing random delays in seconds
+    RETRIES = 3
+    RETRY_STATUSES = (502, 503, 504)
+    RETRY_BACKOFF = 0.5
+    RETRY_MAX_DELAY = 30
+    # Errors of connections failing or dropped while reading the response
+    _DROPPED = (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ReadTimeout)
 
-    def __init__(self, baseuri, username, password, version = VERSION):
+    def __init__(self, baseuri, username, password, version = VERSION,
+                 cookie_file=None, rate_limit=None, rate_burst=None,
+                 max_in_flight=None):
         """baseuri: Base URI for the GenoLogics server, excluding
                     the 'api' or version parts!
                     For example: https://genologics.scilifelab.se:8443/
         username: The account name of the user to login as.
         password: The password for the user account to login as.
         version: The optional LIMS API version, by default 'v2' 
+        cookie_file: The optional file in which to keep the session cookie
+                     between instances, readable only by the user.
+        rate_limit: The optional sustained number of calls per second,
+                    in bursts of up to rate_burst calls.
+        max_in_flight: The optional number of calls in progress at a time.
         """
         self.baseuri = baseuri.rstrip('/') + '/'
         self.username = username
         self.password = password
         self.VERSION = version
         self.cache = dict()
+        self.cache_lock = threading.RLock()
+        # GETs in progress by canonical URI, shared by concurrent callers
+        self._flights = dict()
+        self._flights_lock = threading.Lock()
+        self._reagent_index = None
+        self._parse_warned = False
+        self.udf_schema = None
         # For optimization purposes, enables requests to persist connections
         self.request_session = requests.Session()
         #The connection pool has a default size of 10
-        self.adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=self.POOL_SIZE,
+                                                     pool_maxsize=self.POOL_SIZE)
         self.request_session.mount('http://', self.adapter)
+        self.request_session.mount('https://', self.adapter)
+        self.request_session.headers['accept-encoding'] = self.ACCEPT_ENCODING
+        # Per-thread call state, such as the deadline
+        self._local = threading.local()
+        self.cookie_file = cookie_file
+        self._cookie_lock = threading.Lock()
+        # May be shared with other instances, to limit their calls together
+        self.limiter = Limiter(rate=rate_limit, burst=rate_burst,
+                               max_in_flight=max_in_flight)
+        if cookie_file:
+            self._load_cookies()
+        # Bytes received per call, on the wire and after decoding
+        self.transfers = deque(maxlen=self.TRANSFERS_SIZE)
+        self.transfer_totals = dict(calls=0, wire=0, decoded=0)
+        self._transfer_lock = threading.Lock()
+        # Calls retried, retries by reason, and calls failing after retries
+        self.retry_stats = dict(calls=0, retries=0, recovered=0, failed=0,
+                                delay=0.0, reasons=dict())
+        self._retry_lock = threading.Lock()
 
     def get_uri(self, *segments, **query):
         "Return the full URI given the path segments and optional query."
@@ -51,13 +254,263 @@ class Lims(object):
             url += '?' + urllib.urlencode(query)
         return url
 
+    def request(self, method, uri, **kwargs):
+        """Send the request through the pooled session, once the limiter
+        admits it, with the connect and read timeouts. Within a deadline,
+        the timeouts are cut to the time remaining, and
+        requests.exceptions.Timeout is raised when none remains. Once the
+        server has set a session cookie, the cookie alone authenticates;
+        when it is refused, the request is sent again with the credentials.
+        GETs, PUTs, which replay the same body, and batch retrievals are
+        retried up to RETRIES times when the connection fails or drops
+        before the response is read, or the status is one of
+        RETRY_STATUSES, honouring a Retry-After header up to
+        RETRY_MAX_DELAY seconds. Return the response; a streamed response
+        holds its admission by the limiter until passed to _release.
+        """
+        retry = method in ('GET', 'PUT') or uri.endswith('batch/retrieve')
+        stream = kwargs.get('stream', False)
+        attempt = 0
+        while True:
+            response = error = None
+            priority = getattr(self._local, 'priority', Limiter.INTERACTIVE)
+            if not self.limiter.acquire(priority, getattr(self._local, 'deadline', None)):
+                raise requests.exceptions.Timeout('deadline exceeded')
+            try:
+                response = self._send(method, uri, **kwargs)
+            except self._DROPPED as e:
+                error = e
+            finally:
+                if response is None or not stream:
+                    self.limiter.release()
+                else:
+                    response.admitted = True
+            if response is not None and response.status_code not in self.RETRY_STATUSES:
+                if attempt:
+                    self._count_retry(recovered=1)
+                return response
+            if response is not None:
+                self._release(response)
+            if not (retry and self._retry(attempt, method, uri, error, response)):
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+
+    def _release(self, response):
+        "Release the admission by the limiter held by the streamed response."
+        if getattr(response, 'admitted', False):
+            response.admitted = False
+            self.limiter.release()
+
+    def _retry(self, attempt, method, uri, error=None, response=None):
+        """Wait before the given retry of the call that failed with the error
+        or the response, and return True; or return False if the call
+        is not to be retried any more.
+        """
+        delay = None
+        if attempt < self.RETRIES:
+            delay = self._retry_delay(attempt, response)
+        if delay is None:
+            if attempt:
+                self._count_retry(failed=1)
+            return False
+        reason = 'connection' if response is None else response.status_code
+        logger.warning("%s %s: %s, retry %i in %.1f s", method, uri,
+                       error or response.status_code, attempt + 1, delay)
+        self._count_retry(calls=int(attempt == 0), retries=1, delay=delay,
+                          reason=reason)
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+        return True
+
+    def _retry_delay(self, attempt, response=None):
+        """Return the seconds to wait before the given retry, or None if the
+        wait would exceed RETRY_MAX_DELAY or the deadline.
+        """
+        delay = random.uniform(0, min(self.RETRY_MAX_DELAY,
+                                      self.RETRY_BACKOFF * 2 ** attempt))
+        after = response is not None and response.headers.get('retry-after')
+        if after:
+            try:
+                delay = max(delay, float(after))
+            except ValueError:
+                date = email.utils.parsedate_tz(after)
+                if date is not None:
+                    delay = max(delay, email.utils.mktime_tz(date) - time.time())
+            if delay > self.RETRY_MAX_DELAY:
+                return None
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None and time.time() + delay >= deadline:
+            return None
+        return delay
+
+    def _count_retry(self, reason=None, **counts):
+        with self._retry_lock:
+            for key, value in counts.iteritems():
+                self.retry_stats[key] += value
+            if reason is not None:
+                reasons = self.retry_stats['reasons']
+                reasons[reason] = reasons.get(reason, 0) + 1
+
+    def _send(self, method, uri, **kwargs):
+        if 'auth' not in kwargs and self.request_session.cookies:
+            r = self.request_session.request(method, uri, timeout=self._timeout(),
+                                             **kwargs)
+            if r.status_code != 401:
+                return r
+            r.close()
+            self.request_session.cookies.clear()
+        kwargs.setdefault('auth', (self.username, self.password))
+        r = self.request_session.request(method, uri, timeout=self._timeout(),
+                                         **kwargs)
+        if self.cookie_file and r.cookies:
+            self._save_cookies()
+        return r
+
+    def _load_cookies(self):
+        "Set the session cookies saved for this server and user, if any."
+        try:
+            with open(self.cookie_file) as infile:
+                saved = json.load(infile)
+        except (IOError, ValueError):
+            return
+        if saved.get('baseuri') != self.baseuri or \
+           saved.get('username') != self.username:
+            return
+        for cookie in saved.get('cookies', []):
+            if cookie['expires'] is not None and cookie['expires'] < time.time():
+                continue
+            self.request_session.cookies.set(cookie.pop('name'), cookie.pop('value'),
+                                             **cookie)
+
+    def _save_cookies(self):
+        "Save the session cookies in a file readable only by the user."
+        with self._cookie_lock:
+            cookies = [dict(name=c.name, value=c.value, domain=c.domain, path=c.path,
+                            secure=c.secure, expires=c.expires)
+                       for c in list(self.request_session.cookies)]
+            data = dict(baseuri=self.baseuri, username=self.username, cookies=cookies)
+            fd = os.open(self.cookie_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            # An existing file keeps its mode on open
+            os.fchmod(fd, 0600)
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(data, outfile)
+
+    def _timeout(self):
+        timeout = (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout('deadline exceeded')
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+
+    @contextmanager
+    def deadline(self, seconds):
+        """Context manager bounding the calls made within it, including those
+        on the threads of concurrent calls, to end within the given seconds.
+        Nested deadlines cannot extend an enclosing one.
+        """
+        previous = getattr(self._local, 'deadline', None)
+        deadline = time.time() + seconds
+        if previous is not None:
+            deadline = min(deadline, previous)
+        self._local.deadline = deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    @contextmanager
+    def priority(self, priority):
+        """Context manager giving the calls made within it, including those
+        on the threads of concurrent calls, the priority class of the
+        limiter, Limiter.INTERACTIVE or Limiter.BULK.
+        """
+        previous = getattr(self._local, 'priority', Limiter.INTERACTIVE)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def pool_stats(self):
+        """Return the utilisation of the connection pools, as a dictionary
+        by (scheme, host, port) of dictionaries with the pool size, the
+        connections opened, the requests sent, and the connections idle
+        and in use right now.
+        """
+        result = dict()
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None: continue
+            queue = pool.pool
+            idle = len([c for c in list(queue.queue) if c is not None])
+            result[(pool.scheme, pool.host, pool.port)] = dict(
+                size=queue.maxsize,
+                opened=pool.num_connections,
+                requests=pool.num_requests,
+                idle=idle,
+                in_use=queue.maxsize - queue.qsize())
+        return result
+
     def get(self, uri, params=dict()):
         "GET data from the URI. Return the response XML as an ElementTree."
-        r = self.request_session.get(uri, params=params,
-                         auth=(self.username, self.password),
+        r = self.request('GET', uri, params=params,
                          headers=dict(accept='application/xml'))
         return self.parse_response(r)
 
+    def get_shared(self, uri, instance=None, force=False):
+        """GET data from the URI like get, except that concurrent calls for
+        the same canonical URI share a single request and parse, and
+        return the same ElementTree; errors are raised in all of them.
+        The root of the given entity instance is set before the shared
+        call ends, and is returned without a call if already set, so that
+        no caller arriving later sends the GET again. With force, a new
+        GET is sent rather than sharing one in progress.
+        """
+        if force:
+            root = self.get(uri)
+            if instance is not None:
+                instance.root = root
+            return root
+        key = self._canonical_uri(uri)
+        with self._flights_lock:
+            if instance is not None and instance.root is not None:
+                return instance.root
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+        try:
+            flight.result = self.get(uri)
+            if instance is not None:
+                instance.root = flight.result
+        except Exception:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _canonical_uri(self, uri):
+        "Return the URI with lower-case scheme and host, and sorted query."
+        parts = urlparse.urlsplit(uri)
+        query = '&'.join(sorted(parts.query.split('&'))) if parts.query else ''
+        return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                                    parts.path, query, ''))
+
     def get_file_contents(self, id=None, uri=None):
         """Returns the contents of the file of <ID> or <uri>"""
         if id:
@@ -67,8 +520,9 @@ class Lims(object):
         else:
             raise ValueError("id or uri required")
         url = urlparse.urljoin(self.baseuri, '/'.join(segments))
-        r=self.request_session.get(url, auth=(self.username, self.password))
+        r = self.request('GET', url)
         #TODO add a returncode check here 
+        self._account(r)
         return r.text
 
 
@@ -76,8 +530,7 @@ class Lims(object):
         """PUT the serialized XML to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.put(uri, data=data, params=params,
-                         auth=(self.username, self.password),
+        r = self.request('PUT', uri, data=data, params=params,
                          headers={'content-type':'application/xml',
                                   'accept': 'application/xml'})
         return self.parse_response(r)
@@ -86,18 +539,76 @@ class Lims(object):
         """POST the serialized XML to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.post(uri, data=data, params=params,
-                          auth=(self.username, self.password),
-                          headers={'content-type': 'application/xml',
-                                   'accept': 'application/xml'})
+        r = self.request('POST', uri, data=data, params=params,
+                         headers={'content-type': 'application/xml',
+                                  'accept': 'application/xml'})
         return self.parse_response(r)
 
+    def post_iter(self, uri, data, params=dict()):
+        """POST the serialized XML to the given URI, and parse the response
+        XML incrementally as it arrives. Yield each child element of the
+        root element as soon as it is closed, detached from the root, so
+        that the response is never held in memory as a whole.
+        A batch retrieval whose connection drops mid-stream is sent again,
+        up to RETRIES times, skipping the elements of the URIs already
+        yielded, in whatever order the server returns them.
+        """
+        yielded = set()
+        attempt = 0
+        while True:
+            r = self.request('POST', uri, data=data, params=params,
+                             headers={'content-type': 'application/xml',
+                                      'accept': 'application/xml'},
+                             stream=True)
+            try:
+                for node in self.iter_response(r):
+                    node_uri = node.get('uri')
+                    if node_uri is not None:
+                        if node_uri in yielded: continue
+                        yielded.add(node_uri)
+                    yield node
+            except self._DROPPED as error:
+                if not (uri.endswith('batch/retrieve') and
+                        self._retry(attempt, 'POST', uri, error)):
+                    raise
+            else:
+                if attempt:
+                    self._count_retry(recovered=1)
+                return
+            finally:
+                r.close()
+                self._release(r)
+            attempt += 1
+
+    def iter_response(self, response):
+        """Parse the XML of a streamed response incrementally, yielding each
+        child element of the root element as soon as it is closed.
+        Raise an HTTP error if the response status is not 200.
+        """
+        if response.status_code != 200:
+            self.parse_response(response)
+        response.raw.decode_content = True
+        source = _CountingReader(response.raw)
+        root = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    root.remove(elem)
+                    yield elem
+        self._account(response, source.count)
+
     def check_version(self):
         """Raise ValueError if the version for this interface
         does not match any of the versions given for the API.
         """
         uri = urlparse.urljoin(self.baseuri, 'api')
-        r = requests.get(uri, auth=(self.username, self.password))
+        r = self.request('GET', uri)
         root = self.parse_response(r)
         tag = nsmap('ver:versions')
         assert tag == root.tag
@@ -109,6 +620,7 @@ class Lims(object):
         """Parse the XML returned in the response.
         Raise an HTTP error if the response status is not 200.
         """
+        self._account(response)
         if response.status_code != 200:
             try:
                 root = ElementTree.fromstring(response.content)
@@ -126,7 +638,31 @@ class Lims(object):
             root = ElementTree.fromstring(response.content)
         return root
 
-    def get_udfs(self, name = None, attach_to_name = None, attach_to_category = None, start_index = None):
+    def _account(self, response, decoded=None):
+        """Record the number of bytes of the response body received on the
+        wire, compressed if the server used a content encoding, and after
+        decoding; decoded defaults to the length of the content.
+        """
+        if decoded is None:
+            decoded = len(response.content)
+        try:
+            wire = response.raw.tell()
+        except AttributeError:
+            wire = decoded
+        record = dict(method=response.request and response.request.method,
+                      uri=response.url,
+                      encoding=response.headers.get('content-encoding', 'identity'),
+                      wire=wire,
+                      decoded=decoded)
+        logger.debug("%(method)s %(uri)s: %(wire)i bytes %(encoding)s, "
+                     "%(decoded)i decoded", record)
+        with self._transfer_lock:
+            self.transfers.append(record)
+            self.transfer_totals['calls'] += 1
+            self.transfer_totals['wire'] += wire
+            self.transfer_totals['decoded'] += decoded
+
+    def get_udfs(self, name = None, attach_to_name = None, attach_to_category = None, start_index = None, lazy = False):
         """Get a list of udfs, filtered by keyword arguments.
         name: name of udf
         attach_to_name: item in the system, to wich the udf is attached, such as 
@@ -134,24 +670,129 @@ class Lims(object):
         attach_to_category: If 'attach_to_name' is the name of a process, such as 'CaliperGX QC (DNA)',
              then you need to set attach_to_category='ProcessType'. Must not be provided otherwise.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(name=name,
                                     attach_to_name=attach_to_name,
                                     attach_to_category=attach_to_category,
                                     start_index=start_index)
-        return self._get_instances(Udfconfig, params=params)
+        return self._get_instances(Udfconfig, params=params, lazy=lazy)
 
-    def get_reagent_types(self, name=None, start_index=None):
+    def load_udf_schema(self):
+        """Build the UdfSchema of all the UDF configurations, used by the UDF
+        dictionaries to convert and validate values with the configured types.
+        The configurations are taken from the cache when already retrieved,
+        e.g. by load_config_snapshot.
+        """
+        schema = UdfSchema()
+        udfs = self.get_udfs()
+        self._resolve(udfs)
+        for udf in udfs:
+            # The name is an attribute of the field element in the API
+            name = udf.root.get('name') or udf.name
+            schema.add(udf.attach_to_category, udf.attach_to_name, name, udf.type)
+        self.udf_schema = schema
+        return schema
+
+    def get_reagent_types(self, name=None, start_index=None, lazy=False):
         """Get a list of reqgent types, filtered by keyword arguments.
         name: reagent type  name, or list of names.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(name=name,
                                   start_index=start_index)
-        return self._get_instances(ReagentType, params=params)
+        return self._get_instances(ReagentType, params=params, lazy=lazy)
+
+    def get_reagent_index(self, cache_file=None, max_age=None, names=None):
+        """Get the ReagentIndex of all reagent types, built once per instance.
+        cache_file: Optional path of a file to read the index from and to
+            write it to once built.
+        max_age: Maximum age in seconds of the cache file; any age if None.
+        names: Only get the index of the reagent types of these names,
+            with one list query; neither cached nor stored in the file.
+        """
+        if names is not None:
+            index = ReagentIndex()
+            if names:
+                reagent_types = self.get_reagent_types(name=list(names))
+                self._resolve(reagent_types)
+                for reagent_type in reagent_types:
+                    index.add(reagent_type.name, reagent_type.sequence)
+            return index
+        if self._reagent_index is None:
+            index = None
+            if cache_file:
+                index = ReagentIndex.read(cache_file, max_age=max_age,
+                                          baseuri=self.baseuri)
+            if index is None:
+                index = ReagentIndex()
+                for page in self._iter_pages(ReagentType):
+                    self._resolve(page)
+                    for reagent_type in page:
+                        index.add(reagent_type.name, reagent_type.sequence)
+                if cache_file:
+                    index.write(cache_file, baseuri=self.baseuri)
+            self._reagent_index = index
+        return self._reagent_index
+
+    def load_config_snapshot(self, path, max_age=None):
+        """Warm-start the cache with the configuration entities (process types,
+        container types, protocols and their steps, workflows and their stages,
+        and UDF configurations) stored in the snapshot file at path.
+        If the file is missing, of another version, for another server,
+        or older than max_age seconds, the entities are retrieved from the
+        LIMS and a new snapshot is written to path instead.
+        Return True if the cache was warm-started from the file.
+        """
+        snapshot = self._read_config_snapshot(path, max_age=max_age)
+        if snapshot is not None:
+            classes = dict((k.__name__, k) for k in self.CONFIG_CLASSES)
+            for name, uri, xml in snapshot['entities']:
+                instance = classes[name](self, uri=uri)
+                if instance.root is None:
+                    instance.root = ElementTree.fromstring(xml.encode('UTF-8'))
+            return True
+        entities = []
+        for klass in (Processtype, Containertype, Udfconfig, Protocol, Workflow):
+            for page in self._iter_pages(klass):
+                self._resolve(page)
+                entities.extend(page)
+        steps = [s for p in entities if isinstance(p, Protocol) for s in p.steps]
+        stages = [s for w in entities if isinstance(w, Workflow) for s in w.stages]
+        self._resolve(steps)
+        self._resolve(stages)
+        entities.extend(steps)
+        entities.extend(stages)
+        data = dict(version=self.CONFIG_SNAPSHOT_VERSION,
+                    created=time.time(),
+                    baseuri=self.baseuri,
+                    api_version=self.VERSION,
+                    entities=[(e.__class__.__name__, e.uri,
+                               self.tostring(ElementTree.ElementTree(e.root)))
+                              for e in entities])
+        with open(path, 'w') as outfile:
+            json.dump(data, outfile)
+        return False
+
+    def _read_config_snapshot(self, path, max_age=None):
+        "Return the content of a valid snapshot file, or None."
+        try:
+            with open(path) as infile:
+                snapshot = json.load(infile)
+        except (IOError, ValueError):
+            return None
+        if snapshot.get('version') != self.CONFIG_SNAPSHOT_VERSION:
+            return None
+        if snapshot.get('baseuri') != self.baseuri or \
+           snapshot.get('api_version') != self.VERSION:
+            return None
+        if max_age is not None and time.time() - snapshot.get('created', 0) > max_age:
+            return None
+        return snapshot
 
     def get_labs(self, name=None, last_modified=None,
-                 udf=dict(), udtname=None, udt=dict(), start_index=None):
+                 udf=dict(), udtname=None, udt=dict(), start_index=None, lazy=False):
         """Get a list of labs, filtered by keyword arguments.
         name: Lab name, or list of names.
         last_modified: Since the given ISO format datetime.
@@ -160,16 +801,17 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(name=name,
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Lab, params=params)
+        return self._get_instances(Lab, params=params, lazy=lazy)
 
     def get_researchers(self, firstname=None, lastname=None, username=None,
                         last_modified=None,
-                        udf=dict(), udtname=None, udt=dict(),start_index=None):
+                        udf=dict(), udtname=None, udt=dict(),start_index=None, lazy=False):
         """Get a list of researchers, filtered by keyword arguments.
         firstname: Researcher first name, or list of names.
         lastname: Researcher last name, or list of names.
@@ -180,6 +822,7 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(firstname=firstname,
                                   lastname=lastname,
@@ -187,10 +830,10 @@ class Lims(object):
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Researcher, params=params)
+        return self._get_instances(Researcher, params=params, lazy=lazy)
 
     def get_projects(self, name=None, open_date=None, last_modified=None,
-                     udf=dict(), udtname=None, udt=dict(), start_index=None):
+                     udf=dict(), udtname=None, udt=dict(), start_index=None, lazy=False):
         """Get a list of projects, filtered by keyword arguments.
         name: Project name, or list of names.
         open_date: Since the given ISO format date.
@@ -200,35 +843,105 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(name=name,
                                   open_date=open_date,
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Project, params=params)
+        return self._get_instances(Project, params=params, lazy=lazy)
 
     def get_sample_number(self, name=None, projectname=None, projectlimsid=None,
                     udf=dict(), udtname=None, udt=dict(), start_index=None):
         """Gets the number of samples matching the query without fetching every
         sample, so it should be faster than len(get_samples()"""
-        params = self._get_params(name=name,
-                                  projectname=projectname,
-                                  projectlimsid=projectlimsid,
-                                  start_index=start_index)
+        return self.count(Sample, name=name,
+                          projectname=projectname,
+                          projectlimsid=projectlimsid,
+                          udf=udf, udtname=udtname, udt=udt,
+                          start_index=start_index)
+
+    def count(self, klass, udf=dict(), udtname=None, udt=dict(), **kwargs):
+        """Get the number of instances of klass matching the keyword arguments,
+        which are those of the corresponding get_* method, from start_index
+        on if given, as a Query iterates them. No instances are created,
+        and the pages after the second are fetched concurrently, in
+        growing windows.
+        """
+        params = self._get_params(**kwargs)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        root = self.get(self.get_uri(Sample._URI), params=params)
-        total=0
-        while params.get('start-index') is None: # Loop over all pages.
-            total+=len(root.findall("sample"))
-            node = root.find('next-page')
-            if node is None: break
-            root = self.get(node.attrib['uri'], params=params)
-        return total
+        return self._count(klass, params)
+
+    def first(self, klass, udf=dict(), udtname=None, udt=dict(), **kwargs):
+        """Get the first instance of klass matching the keyword arguments,
+        which are those of the corresponding get_* method, or None.
+        Only the first page is fetched.
+        """
+        params = self._get_params(**kwargs)
+        params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
+        return self._first(klass, params)
+
+    def exists(self, klass, udf=dict(), udtname=None, udt=dict(), **kwargs):
+        """Return True if any instance of klass matches the keyword arguments,
+        which are those of the corresponding get_* method.
+        """
+        return self.first(klass, udf=udf, udtname=udtname, udt=udt, **kwargs) is not None
 
+    def query(self, klass, udf=dict(), udtname=None, udt=dict(), **kwargs):
+        """Return a lazy Query for instances of klass matching the keyword
+        arguments, which are those of the corresponding get_* method.
+        """
+        return Query(self, klass).filter(udf=udf, udtname=udtname, udt=udt, **kwargs)
+
+    def multi_query(self, queries):
+        """Run the independent queries concurrently over the shared
+        connection pool, and return the list of their results, in order.
+        A Query object gives the list of its instances; any other item is
+        called without arguments, e.g. the first or count method of a Query.
+        """
+        return self._map(lambda q: list(q) if isinstance(q, Query) else q(), queries)
+
+    def _count(self, klass, params):
+        if len(self._split_params(klass, params)) > 1:
+            # Chunks may overlap, so the instances must be compared
+            return len(self._get_instances(klass, params=params))
+        tag = self._get_tag(klass)
+        root = self.get(self.get_uri(klass._URI), params=params)
+        total = len(root.findall(tag))
+        if root.find('next-page') is None:
+            return total
+        page_size = total
+
+        def count_page(start):
+            page_params = dict(params)
+            page_params['start-index'] = start
+            root = self.get(self.get_uri(klass._URI), params=page_params)
+            return len(root.findall(tag)), root.find('next-page') is not None
+
+        # Windows of 1, 2, 4... concurrent pages, to fetch few past the end
+        start = int(params.get('start-index', 0)) + page_size
+        window = 1
+        with self.priority(Limiter.BULK):
+            while True:
+                starts = [start + i * page_size for i in xrange(window)]
+                for count, has_next in self._map(count_page, starts):
+                    total += count
+                    if not has_next:
+                        return total
+                start = starts[-1] + page_size
+                window = min(2 * window, self.WORKERS)
+
+    def _first(self, klass, params):
+        for chunk_params in self._split_params(klass, params):
+            for page in self._iter_pages(klass, params=chunk_params):
+                if page:
+                    return page[0]
+                break
+        return None
 
     def get_samples(self, name=None, projectname=None, projectlimsid=None,
-                    udf=dict(), udtname=None, udt=dict(), start_index=None):
+                    udf=dict(), udtname=None, udt=dict(), start_index=None, lazy=False):
         """Get a list of samples, filtered by keyword arguments.
         name: Sample name, or list of names.
         projectlimsid: Samples for the project of the given LIMS id.
@@ -238,20 +951,21 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(name=name,
                                   projectname=projectname,
                                   projectlimsid=projectlimsid,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Sample, params=params)
+        return self._get_instances(Sample, params=params, lazy=lazy)
 
     def get_artifacts(self, name=None, type=None, process_type=None,
                       artifact_flag_name=None, working_flag=None, qc_flag=None,
                       sample_name=None, samplelimsid=None, artifactgroup=None, containername=None,
                       containerlimsid=None, reagent_label=None,
                       udf=dict(), udtname=None, udt=dict(), start_index=None,
-                      resolve=False):
+                      resolve=False, lazy=False):
         """Get a list of artifacts, filtered by keyword arguments.
         name: Artifact name, or list of names.
         type: Artifact type, or list of types.
@@ -270,7 +984,11 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list; resolve it with
+              its resolve method, as resolve=True is not allowed with it.
         """
+        if resolve and lazy:
+            raise ValueError('resolve the lazy Query with its resolve method')
         params = self._get_params(name=name,
                                   type=type,
                                   process_type=process_type,
@@ -288,11 +1006,11 @@ class Lims(object):
         if resolve:
             return self.get_batch(self._get_instances(Artifact, params=params))
         else:
-            return self._get_instances(Artifact, params=params)
+            return self._get_instances(Artifact, params=params, lazy=lazy)
 
     def get_containers(self, name=None, type=None,
                        state=None, last_modified=None,
-                       udf=dict(), udtname=None, udt=dict(), start_index=None):
+                       udf=dict(), udtname=None, udt=dict(), start_index=None, lazy=False):
         """Get a list of containers, filtered by keyword arguments.
         name: Containers name, or list of names.
         type: Container type, or list of types.
@@ -303,6 +1021,7 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(name=name,
                                   type=type,
@@ -310,12 +1029,12 @@ class Lims(object):
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Container, params=params)
+        return self._get_instances(Container, params=params, lazy=lazy)
 
     def get_processes(self, last_modified=None, type=None,
                       inputartifactlimsid=None,
                       techfirstname=None, techlastname=None, projectname=None,
-                      udf=dict(), udtname=None, udt=dict(), start_index=None):
+                      udf=dict(), udtname=None, udt=dict(), start_index=None, lazy=False):
         """Get a list of processes, filtered by keyword arguments.
         last_modified: Since the given ISO format datetime.
         type: Process type, or list of types.
@@ -328,6 +1047,7 @@ class Lims(object):
         techlastname: Last name of researcher, or list of.
         projectname: Name of project, or list of.
         start_index: Page to retrieve; all if None.
+        lazy: Return a lazy Query instead of a list.
         """
         params = self._get_params(last_modified=last_modified,
                                   type=type,
@@ -337,7 +1057,7 @@ class Lims(object):
                                   projectname=projectname,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Process, params=params)
+        return self._get_instances(Process, params=params, lazy=lazy)
 
     def _get_params(self, **kwargs):
         "Convert keyword arguments to a kwargs dictionary."
@@ -358,18 +1078,102 @@ class Lims(object):
             result["udt.%s" % key] = value
         return result
 
-    def _get_instances(self, klass, params=dict()):
-        result = []
+    def _get_tag(self, klass):
+        "Return the tag of the klass elements in its listing."
         tag = klass._TAG
         if tag is None:
             tag = klass.__name__.lower()
+        return tag
+
+    def _map(self, func, items):
+        """Return the list of func applied to each of the items, computed
+        by at most WORKERS concurrent threads sharing the connection pool.
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return map(func, items)
+        state = dict(self._local.__dict__)
+        def call(item):
+            self._local.__dict__.update(state)
+            return func(item)
+        pool = ThreadPool(min(self.WORKERS, len(items)))
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+
+    def _iter_pages(self, klass, params=dict(), follow=None):
+        """Yield the list of instances on each page of the listing of klass.
+        Unless follow is given, only the requested page is fetched
+        if 'start-index' is given.
+        """
+        if follow is None:
+            follow = params.get('start-index') is None
+        tag = self._get_tag(klass)
         root = self.get(self.get_uri(klass._URI), params=params)
-        while params.get('start-index') is None: # Loop over all pages.
-            for node in root.findall(tag):
-                result.append(klass(self, uri=node.attrib['uri']))
+        while True:
+            yield [klass(self, uri=node.attrib['uri']) for node in root.findall(tag)]
             node = root.find('next-page')
-            if node is None: break
-            root = self.get(node.attrib['uri'], params=params)
+            if node is None or not follow: break
+            # The next-page URIs carry the whole query, with their start-index
+            root = self.get(node.attrib['uri'])
+
+    def _url_length(self, uri, params):
+        "Return the length of the URI with the encoded query parameters."
+        query = []
+        for key, value in params.iteritems():
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for item in value:
+                if isinstance(item, unicode):
+                    item = item.encode('UTF-8')
+                query.append((key, item))
+        return len(uri) + 1 + len(urllib.urlencode(query))
+
+    def _split_params(self, klass, params):
+        """Split the params into a list of params whose query URLs are at
+        most MAX_URL_LENGTH long, by halving the longest list-valued
+        parameters. The union of their results is the result of params.
+        """
+        uri = self.get_uri(klass._URI)
+        # The next-page URIs add a start-index to the query
+        paged = dict(params)
+        paged.setdefault('start-index', 10 ** 6)
+        if self._url_length(uri, paged) <= self.MAX_URL_LENGTH:
+            return [params]
+        key, values = max(params.iteritems(),
+                          key=lambda kv: isinstance(kv[1], (list, tuple)) and len(kv[1]))
+        if not isinstance(values, (list, tuple)) or len(values) < 2:
+            return [params]
+        values = list(values)
+        half = len(values) // 2
+        result = []
+        for chunk in (values[:half], values[half:]):
+            chunk_params = dict(params)
+            chunk_params[key] = chunk
+            result.extend(self._split_params(klass, chunk_params))
+        return result
+
+    def _get_instances(self, klass, params=dict(), lazy=False):
+        """Get the list of instances of klass matching the params.
+        Too long list-valued params are split up, and the chunks
+        queried concurrently and merged without duplicates.
+        """
+        if lazy:
+            return Query(self, klass, params)
+        chunks = self._split_params(klass, params)
+        if len(chunks) == 1:
+            result = []
+            for page in self._iter_pages(klass, params=params):
+                result.extend(page)
+            return result
+        result = []
+        seen = set()
+        for instances in self._map(lambda p: self._get_instances(klass, params=p), chunks):
+            for instance in instances:
+                if instance.uri in seen: continue
+                seen.add(instance.uri)
+                result.append(instance)
         return result
 
     def get_batch(self, instances):
@@ -383,20 +1187,155 @@ class Lims(object):
                                                       rel=klass._URI))
         uri = self.get_uri(klass._URI, 'batch/retrieve')
         data = self.tostring(ElementTree.ElementTree(root))
-        root = self.post(uri, data)
+        if self.PARSE_WORKERS > 1 and not xml_backend.LXML and not self._parse_warned:
+            logger.warning("PARSE_WORKERS needs lxml; parsing batches as they stream")
+            self._parse_warned = True
+        if self.PARSE_WORKERS > 1 and xml_backend.LXML:
+            r = self.request('POST', uri, data=data,
+                             headers={'content-type': 'application/xml',
+                                      'accept': 'application/xml'})
+            if r.status_code != 200:
+                self.parse_response(r)
+            self._account(r)
+            nodes = self._parse_batch(r.content)
+        else:
+            nodes = self.post_iter(uri, data)
         result = []
-        for node in root.getchildren():
+        for node in nodes:
             instance = klass(self, uri=node.attrib['uri'])
             instance.root = node
             result.append(instance)
         return result
 
+    _TAG = re.compile(r'<([\w.:-]+)[^>]*>')
+
+    def _split_batch(self, content):
+        """Split the batch response XML at entity boundaries into documents
+        of about PARSE_CHUNK_SIZE bytes, each with the root element of the
+        response around its share of the entities.
+        """
+        root = self._TAG.search(content)
+        child = root and self._TAG.search(content, root.end())
+        # Without a namespace prefix, entity tags might occur nested, and
+        # within CDATA sections or comments, tags might occur in any text
+        if child is None or ':' not in child.group(1) or \
+           '<![CDATA[' in content or '<!--' in content:
+            return [content]
+        head = content[:root.end()]
+        tail = '</%s>' % root.group(1)
+        close = '</%s>' % child.group(1)
+        boundary = re.compile(r'\s*(<%s[\s/>]|%s)' % (re.escape(child.group(1)),
+                                                       re.escape(tail)))
+        result = []
+        start = child.start()
+        pos = start + self.PARSE_CHUNK_SIZE
+        while True:
+            pos = content.find(close, pos)
+            if pos < 0:
+                break
+            pos += len(close)
+            # Split only where the next entity or the end of the root follows
+            if not boundary.match(content, pos):
+                continue
+            result.append(head + content[start:pos] + tail)
+            start = pos
+            pos = start + self.PARSE_CHUNK_SIZE
+        result.append(head + content[start:])
+        return result
+
+    def _parse_batch(self, content):
+        """Parse the batch response XML split at entity boundaries on at
+        most PARSE_WORKERS threads. Return the entity elements in order.
+        """
+        chunks = self._split_batch(content)
+        if len(chunks) == 1:
+            return list(ElementTree.fromstring(content))
+        pool = ThreadPool(min(self.PARSE_WORKERS, len(chunks)))
+        try:
+            roots = pool.map(ElementTree.fromstring, chunks)
+        except ElementTree.ParseError:
+            # Split where the entities do not end; parse the whole response
+            return list(ElementTree.fromstring(content))
+        finally:
+            pool.close()
+        return [node for root in roots for node in root]
+
+    def _resolve(self, instances, force=False):
+        """Get the content of the instances not retrieved yet, or of all
+        of them if force is True; artifacts, samples and containers with
+        one batch call, others one by one on concurrent threads.
+        """
+        todo = [i for i in instances if force or i.root is None]
+        if not todo: return
+        if isinstance(todo[0], (Artifact, Sample, Container)):
+            self.get_batch(todo)
+        else:
+            self._map(lambda i: i.get(force=force), todo)
+
+    def ancestors(self, artifacts, depth=None):
+        """Get the artifacts upstream of the given artifacts, nearest first,
+        by walking the parent processes breadth-first. Each frontier of
+        artifacts is retrieved with one batch call.
+        depth: Number of processes to walk back; all if None.
+        """
+        seen = set(a.id for a in artifacts)
+        result = []
+        frontier = list(artifacts)
+        level = 0
+        while frontier and (depth is None or level < depth):
+            level += 1
+            self._resolve(frontier)
+            parents = dict()
+            for artifact in frontier:
+                parent = artifact.parent_process
+                if parent is not None:
+                    parents.setdefault(parent, []).append(artifact)
+            self._resolve(parents.keys())
+            found = []
+            for parent, outputs in parents.iteritems():
+                for output in outputs:
+                    for input in parent.io_map.inputs_per_output(output.id):
+                        if input.id in seen: continue
+                        seen.add(input.id)
+                        found.append(input)
+            result.extend(found)
+            frontier = found
+        self._resolve(result)
+        return result
+
+    def descendants(self, artifacts, depth=None):
+        """Get the artifacts downstream of the given artifacts, nearest first,
+        by walking the child processes breadth-first. The child processes of
+        each frontier are found with one inputartifactlimsid list query.
+        depth: Number of processes to walk forward; all if None.
+        """
+        seen = set(a.id for a in artifacts)
+        result = []
+        frontier = list(artifacts)
+        level = 0
+        while frontier and (depth is None or level < depth):
+            level += 1
+            ids = [a.id for a in frontier]
+            processes = self.get_processes(inputartifactlimsid=ids)
+            self._resolve(processes)
+            found = []
+            frontier_ids = set(ids)
+            for process in processes:
+                for id in process.io_map.by_input:
+                    if id not in frontier_ids: continue
+                    for output in process.io_map.outputs_per_input(id):
+                        if output.id in seen: continue
+                        seen.add(output.id)
+                        found.append(output)
+            result.extend(found)
+            frontier = found
+        self._resolve(result)
+        return result
+
     def tostring(self, etree):
         "Return the ElementTree contents as a UTF-8 encoded XML string."
-        outfile = StringIO()
-        self.write(outfile, etree)
-        return outfile.getvalue()
+        return xml_backend.tostring(etree)
 
     def write(self, outfile, etree):
         "Write the ElementTree contents as UTF-8 encoded XML to the open file."
-        etree.write(outfile, encoding='UTF-8')
+        xml_backend.write(outfile, etree)
@@ -7,8 +7,9 @@ import sys
 import os
 
 from genologics.lims import *
-from genologics.config import BASEURI, USERNAME, PASSWORD
-lims = Lims(BASEURI, USERNAME, PASSWORD)
+from genologics.entities import GenealogyGraph
+from genologics.config import BASEURI, USERNAME, PASSWORD, LIMITS
+lims = Lims(BASEURI, USERNAME, PASSWORD, **LIMITS)
 
 def get_run_info(fc):
 	fc_summary={}
@@ -22,29 +23,9 @@ def get_run_info(fc):
 def procHistory(proc, samplename):
     """Quick wat to get the ids of parent processes from the given process, 
     while staying in a sample scope"""
-    hist=[]
-    artifacts = lims.get_artifacts(sample_name = samplename, type = 'Analyte')
-    not_done=True
+    graph = GenealogyGraph(lims, [samplename])
     starting_art=proc.input_per_sample(samplename)[0].id
-    while not_done:
-        not_done=False
-        for o in artifacts:
-            if o.id == starting_art:
-                if o.parent_process is None:
-                    #flow control : if there is no parent process, we can stop iterating, we're done.
-                    not_done=False
-                    break #breaks the for artifacts, we are done anyway.
-                else:
-                    not_done=True #keep the loop running
-                hist.append(o.parent_process.id)
-                for i in o.parent_process.all_inputs():
-                    if i in artifacts:
-                        # while increment
-                        starting_art=i.id
-
-                        break #break the for allinputs, if we found the right one
-                break # breaks the for artifacts if we matched the current one
-    return hist
+    return [parent.id for art_id, parent, input_id in graph.sample_lineage(samplename, starting_art)]
 
 def get_sequencing_info(fc):
     """Input: a process object 'fc', of type 'Illumina Sequencing (Illumina SBS) 4.0',
@@ -62,7 +43,7 @@ def make_sample_artifact_maps(sample_name):
     """outin: connects each out_art for a specific sample to its 
     corresponding in_art and process. one-one relation"""
     outin = {}
-    artifacts = lims.get_artifacts(sample_name = sample_name, type = 'Analyte')
+    artifacts = lims.get_artifacts(sample_name = sample_name, type = 'Analyte', resolve=True)
     for outart in artifacts:
         try:
             pro = outart.parent_process
@@ -0,0 +1,270 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Local SQLite mirror of LIMS entities, for indexed offline queries.
+"""
+
+import sqlite3
+import logging
+
+from .xml_backend import ElementTree
+from .limiter import Limiter
+from .entities import (Lab, Researcher, Project, Sample, Containertype,
+                       Container, Processtype, Process, Artifact)
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entity (
+    uri TEXT PRIMARY KEY,
+    class TEXT NOT NULL,
+    limsid TEXT,
+    name TEXT,
+    type TEXT,
+    project TEXT,
+    container TEXT,
+    well TEXT,
+    process TEXT,
+    process_type TEXT,
+    date TEXT,
+    xml TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS entity_class_name ON entity (class, name);
+CREATE INDEX IF NOT EXISTS entity_project ON entity (project);
+CREATE INDEX IF NOT EXISTS entity_container_well ON entity (container, well);
+CREATE INDEX IF NOT EXISTS entity_process_type ON entity (process_type);
+CREATE INDEX IF NOT EXISTS entity_date ON entity (class, date);
+CREATE TABLE IF NOT EXISTS udf (
+    uri TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value_text TEXT,
+    value_number REAL);
+CREATE INDEX IF NOT EXISTS udf_uri ON udf (uri);
+CREATE INDEX IF NOT EXISTS udf_number ON udf (name, value_number);
+CREATE INDEX IF NOT EXISTS udf_text ON udf (name, value_text);
+CREATE TABLE IF NOT EXISTS artifact_sample (
+    artifact TEXT NOT NULL,
+    sample TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS artifact_sample_artifact ON artifact_sample (artifact);
+CREATE INDEX IF NOT EXISTS artifact_sample_sample ON artifact_sample (sample);
+CREATE TABLE IF NOT EXISTS process_io (
+    process TEXT NOT NULL,
+    input TEXT,
+    output TEXT,
+    output_type TEXT);
+CREATE INDEX IF NOT EXISTS process_io_process ON process_io (process);
+CREATE INDEX IF NOT EXISTS process_io_input ON process_io (input);
+CREATE INDEX IF NOT EXISTS process_io_output ON process_io (output);
+"""
+
+_OPERATORS = ('=', '!=', '<', '<=', '>', '>=')
+
+
+def _stateless(uri):
+    "Return the URI without its query, e.g. the artifact state."
+    return uri.split('?')[0]
+
+
+class Mirror(object):
+    """Local relational mirror of LIMS entities in an SQLite database.
+
+    Entities are stored with their XML, their UDF values and their
+    artifact-sample and process input-output relationships, indexed for
+    queries that would otherwise need multi-page REST crawls.
+    Entities read back from the mirror are ordinary instances of the
+    entity classes, with their XML taken from the database.
+    """
+
+    CLASSES = dict((k.__name__, k) for k in (Lab, Researcher, Project, Sample,
+                                             Containertype, Container,
+                                             Processtype, Process, Artifact))
+
+    def __init__(self, lims, path=':memory:'):
+        """lims: the Lims instance that entities read back are bound to.
+        path: file of the SQLite database; in memory by default.
+        """
+        self.lims = lims
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def store(self, instances):
+        """Store the retrieved instances, replacing any previous version.
+        Whatever is still to be retrieved is fetched as bulk calls.
+        """
+        with self.connection, self.lims.priority(Limiter.BULK):
+            for instance in instances:
+                if instance.__class__.__name__ not in self.CLASSES:
+                    raise ValueError("cannot mirror %s" % instance.__class__.__name__)
+                self._store(instance)
+
+    def store_changes(self, changed):
+        "Store the dictionary of updated instances returned by DeltaSync.sync."
+        for instances in changed.values():
+            self.store(instances)
+
+    def _store(self, instance):
+        uri = _stateless(instance.uri)
+        row = dict(uri=uri, limsid=instance.id, name=None, type=None,
+                   project=None, container=None, well=None, process=None,
+                   process_type=None, date=None)
+        cursor = self.connection.cursor()
+        for table, column in (('udf', 'uri'), ('artifact_sample', 'artifact'),
+                              ('process_io', 'process')):
+            cursor.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (uri,))
+        root = instance.root
+        if not isinstance(instance, Process):
+            row['name'] = instance.name
+        if isinstance(instance, Project):
+            row['date'] = instance.open_date
+        elif isinstance(instance, Sample):
+            row['date'] = instance.date_received
+            node = root.find('project')
+            if node is not None:
+                row['project'] = node.attrib['uri']
+        elif isinstance(instance, Container):
+            node = root.find('type')
+            if node is not None:
+                row['type'] = node.get('name')
+        elif isinstance(instance, Process):
+            node = root.find('type')
+            if node is not None:
+                row['process_type'] = node.text
+            row['date'] = instance.date_run
+            for input, output in instance.io_map.maps:
+                cursor.execute("INSERT INTO process_io VALUES (?, ?, ?, ?)",
+                               (uri,
+                                input and _stateless(input['uri'].uri),
+                                output and _stateless(output['uri'].uri),
+                                output and output.get('output-type')))
+        elif isinstance(instance, Artifact):
+            row['type'] = instance.type
+            node = root.find('location')
+            if node is not None and node.find('container') is not None:
+                row['container'] = node.find('container').attrib['uri']
+                row['well'] = node.find('value').text
+            node = root.find('parent-process')
+            if node is not None:
+                row['process'] = node.attrib['uri']
+            for node in root.findall('sample'):
+                cursor.execute("INSERT INTO artifact_sample VALUES (?, ?)",
+                               (uri, node.attrib['uri']))
+        if not isinstance(instance, (Containertype, Processtype)):
+            for name, value in instance.udf.items():
+                number = None
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    number = value
+                text = value if value is None else unicode(value)
+                cursor.execute("INSERT INTO udf VALUES (?, ?, ?, ?)",
+                               (uri, name, text, number))
+        xml = self.lims.tostring(ElementTree.ElementTree(root)).decode('UTF-8')
+        cursor.execute("INSERT OR REPLACE INTO entity VALUES"
+                       " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (uri, instance.__class__.__name__, row['limsid'],
+                        row['name'], row['type'], row['project'],
+                        row['container'], row['well'], row['process'],
+                        row['process_type'], row['date'], xml))
+
+    def get(self, uri):
+        "Return the mirrored instance with the given URI, or None."
+        rows = self.connection.execute(
+            "SELECT class, xml FROM entity WHERE uri = ?", (_stateless(uri),)).fetchall()
+        if not rows:
+            return None
+        return self._instance(uri, *rows[0])
+
+    def _instance(self, uri, klass, xml):
+        instance = self.CLASSES[klass](self.lims, uri=uri)
+        if instance.root is None:
+            instance.root = ElementTree.fromstring(xml.encode('UTF-8'))
+        return instance
+
+    def find(self, klass, name=None, type=None, projectname=None, containername=None,
+             well=None, process_type=None, since=None, udf=dict()):
+        """Return the mirrored instances of klass matching all the filters.
+        name: Instance name.
+        type: Artifact type, e.g. Analyte, or container type name.
+        projectname: Samples and artifacts of the project of that name.
+        containername: Artifacts in the container of that name.
+        well: Artifacts in that well, e.g. 'A:1'.
+        process_type: Processes of that type, or artifacts produced by them.
+        since: Instances with a date (open, received or run) on or after this.
+        udf: dictionary of UDF values by name; a value may be a tuple
+             (operator, value) with one of =, !=, <, <=, >, >=.
+        """
+        where = ["e.class = ?"]
+        args = [klass.__name__]
+        if name is not None:
+            where.append("e.name = ?")
+            args.append(name)
+        if type is not None:
+            where.append("e.type = ?")
+            args.append(type)
+        if projectname is not None:
+            if klass is Artifact:
+                where.append("e.uri IN (SELECT a.artifact FROM artifact_sample a"
+                             " JOIN entity s ON s.uri = a.sample"
+                             " JOIN entity p ON p.uri = s.project WHERE p.name = ?)")
+            else:
+                where.append("e.project IN (SELECT uri FROM entity"
+                             " WHERE class = 'Project' AND name = ?)")
+            args.append(projectname)
+        if containername is not None:
+            where.append("e.container IN (SELECT uri FROM entity"
+                         " WHERE class = 'Container' AND name = ?)")
+            args.append(containername)
+        if well is not None:
+            where.append("e.well = ?")
+            args.append(well)
+        if process_type is not None:
+            if klass is Process:
+                where.append("e.process_type = ?")
+            else:
+                where.append("e.process IN (SELECT uri FROM entity"
+                             " WHERE class = 'Process' AND process_type = ?)")
+            args.append(process_type)
+        if since is not None:
+            where.append("e.date >= ?")
+            args.append(since)
+        for udf_name, value in udf.iteritems():
+            operator = '='
+            if isinstance(value, tuple):
+                operator, value = value
+            if operator not in _OPERATORS:
+                raise ValueError("invalid UDF operator '%s'" % operator)
+            column = 'value_text'
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                column = 'value_number'
+            elif value is not None:
+                value = unicode(value)
+            where.append("e.uri IN (SELECT uri FROM udf WHERE name = ? AND %s %s ?)"
+                         % (column, operator))
+            args.extend([udf_name, value])
+        rows = self.connection.execute(
+            "SELECT e.uri, e.class, e.xml FROM entity e WHERE " + " AND ".join(where),
+            args).fetchall()
+        return [self._instance(*row) for row in rows]
+
+    def inputs(self, process):
+        "Return the mirrored input artifacts of the given process."
+        return self._related("SELECT DISTINCT input FROM process_io WHERE process = ?",
+                             process)
+
+    def outputs(self, process):
+        "Return the mirrored output artifacts of the given process."
+        return self._related("SELECT DISTINCT output FROM process_io WHERE process = ?",
+                             process)
+
+    def child_processes(self, artifact):
+        "Return the mirrored processes using the given artifact as input."
+        return self._related("SELECT DISTINCT process FROM process_io WHERE input = ?",
+                             artifact)
+
+    def _related(self, sql, instance):
+        result = []
+        for (uri,) in self.connection.execute(sql, (_stateless(instance.uri),)):
+            if uri is None: continue
+            related = self.get(uri)
+            if related is not None:
+                result.append(related)
+        return result
@@ -0,0 +1,98 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Delta synchronization of the entities cached by a LIMS interface.
+"""
+
+import datetime
+import json
+import logging
+
+from .entities import Lab, Researcher, Project, Sample, Container, Process, Artifact
+from .limiter import Limiter
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaSync(object):
+    """Keeps the entities in the cache of a Lims instance up to date.
+
+    Each call to sync polls the last_modified filters of the labs,
+    researchers, projects, containers and processes listings, and
+    retrieves only what changed since the previous call, using batch
+    calls where the API has them. The artifacts and samples, which cannot
+    be filtered on modification, are refreshed through the changed
+    processes, containers and projects.
+    """
+
+    # Format of the last_modified query parameter
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    # Seconds subtracted from the sync start time, to tolerate clock skew
+    OVERLAP = 60
+
+    def __init__(self, lims, since=None, state_file=None):
+        """lims: the Lims instance whose cache is kept up to date.
+        since: ISO format datetime of the previous sync; everything is
+            retrieved on the first sync if None.
+        state_file: optional path of a JSON file keeping the time of the
+            last sync between runs; overrides since if it exists.
+        """
+        self.lims = lims
+        self.since = since
+        self.state_file = state_file
+        if state_file:
+            try:
+                with open(state_file) as infile:
+                    self.since = json.load(infile)['since']
+            except (IOError, ValueError, KeyError):
+                pass
+
+    def sync(self):
+        """Retrieve the entities modified since the previous sync.
+        Return a dictionary of the lists of updated instances by class.
+        """
+        started = datetime.datetime.utcnow()
+        lims = self.lims
+        # Crawls yield to the interactive calls made meanwhile
+        with lims.priority(Limiter.BULK):
+            changed = dict()
+            changed[Lab] = lims.get_labs(last_modified=self.since)
+            changed[Researcher] = lims.get_researchers(last_modified=self.since)
+            changed[Project] = lims.get_projects(last_modified=self.since)
+            changed[Container] = lims.get_containers(last_modified=self.since)
+            changed[Process] = lims.get_processes(last_modified=self.since)
+            for klass in (Lab, Researcher, Project, Container, Process):
+                lims._resolve(changed[klass], force=True)
+
+            artifacts = dict()
+            for process in changed[Process]:
+                for input, output in process.io_map.maps:
+                    for io in (input, output):
+                        if io is not None:
+                            artifact = io['uri'].stateless
+                            artifacts[artifact.uri] = artifact
+            for container in changed[Container]:
+                for artifact in container.placements.values():
+                    artifact = artifact.stateless
+                    artifacts[artifact.uri] = artifact
+            changed[Artifact] = artifacts.values()
+            lims._resolve(changed[Artifact], force=True)
+
+            samples = dict()
+            if changed[Project]:
+                for sample in lims.get_samples(projectlimsid=[p.id for p in changed[Project]]):
+                    samples[sample.uri] = sample
+            for artifact in changed[Artifact]:
+                for node in artifact.root.findall('sample'):
+                    sample = Sample(lims, uri=node.attrib['uri'])
+                    samples[sample.uri] = sample
+            changed[Sample] = samples.values()
+            lims._resolve(changed[Sample], force=True)
+
+        since = started - datetime.timedelta(seconds=self.OVERLAP)
+        self.since = since.strftime(self.TIME_FORMAT)
+        if self.state_file:
+            with open(self.state_file, 'w') as outfile:
+                json.dump(dict(since=self.since), outfile)
+        logger.info("Synced {0} entities, next sync since {1}".format(
+            sum(len(v) for v in changed.values()), self.since))
+        return changed
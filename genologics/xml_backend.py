@@ -0,0 +1,46 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+XML backend: lxml when it is installed, for faster parsing, XPath and
+C-level serialization, otherwise the standard library cElementTree.
+Set the environment variable GENOLOGICS_XML_BACKEND to 'etree' to force
+the standard library.
+
+All element trees handled by the entities must come from the same
+backend; use the ElementTree exported here rather than importing one.
+"""
+
+import os
+
+LXML = False
+if os.environ.get('GENOLOGICS_XML_BACKEND', 'lxml') != 'etree':
+    try:
+        from lxml import etree as ElementTree
+        LXML = True
+    except ImportError:
+        pass
+if not LXML:
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+
+
+def register_namespace(prefix, uri):
+    "Register the prefix to use for the namespace URI when serializing."
+    ElementTree.register_namespace(prefix, uri)
+
+
+def tostring(etree):
+    "Return the ElementTree contents as a UTF-8 encoded XML string."
+    if LXML:
+        return ElementTree.tostring(etree, encoding='UTF-8', xml_declaration=True)
+    return ElementTree.tostring(etree.getroot(), encoding='UTF-8')
+
+
+def write(outfile, etree):
+    "Write the ElementTree contents as UTF-8 encoded XML to the open file."
+    if LXML:
+        etree.write(outfile, encoding='UTF-8', xml_declaration=True)
+    else:
+        etree.write(outfile, encoding='UTF-8')
+
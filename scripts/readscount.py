@@ -24,13 +24,16 @@ def main(lims, args, logger):
     errnb=0
     summary={}
     logart=None
-    for output_artifact in p.all_outputs():
+    outputs=p.all_outputs()
+    samples=[o.samples[0] for o in outputs if o.type=='Analyte' and len(o.samples)==1]
+    fastq_arts=get_fastq_artifacts(samples)
+    for output_artifact in outputs:
         #filter to only keep solo sample demultiplexing output artifacts
         if output_artifact.type=='Analyte' and len(output_artifact.samples)==1:
             sample=output_artifact.samples[0]
             samplenb+=1
             #update the total number of reads
-            total_reads=sumreads(sample, summary)
+            total_reads=sumreads(sample, summary, fastq_arts.get(sample.name, []))
             sample.udf['Total Reads (M)']=total_reads
             output_artifact.udf['Set Total Reads']=total_reads
             logging.info("Total reads is {0} for sample {1}".format(sample.udf['Total Reads (M)'],sample.name))
@@ -84,11 +87,27 @@ def demnumber(sample):
             dem.add(a.parent_process.id)
     return len(dem)
     
-def sumreads(sample, summary):
+def get_fastq_artifacts(samples):
+    """Returns the demultiplexing artifacts of all the given samples, fetched together
+    and grouped by sample name"""
+    fastq_arts={}
+    if not samples:
+        return fastq_arts
+    names=dict(("{0} (FASTQ reads)".format(s.name), s.name) for s in samples)
+    #Only the sample names are sent: splitting two long lists would query their cross product
+    arts=lims.get_artifacts(sample_name=[s.name for s in samples], process_type=DEMULTIPLEX.values(),
+                            resolve=True)
+    for a in arts:
+        if a.name in names:
+            fastq_arts.setdefault(names[a.name], []).append(a)
+    return fastq_arts
+
+def sumreads(sample, summary, arts=None):
     if sample.name not in summary:
         summary[sample.name]={}
-    expectedName="{0} (FASTQ reads)".format(sample.name)
-    arts=lims.get_artifacts(sample_name=sample.name,process_type=DEMULTIPLEX.values(), name=expectedName)   
+    if arts is None:
+        expectedName="{0} (FASTQ reads)".format(sample.name)
+        arts=lims.get_artifacts(sample_name=sample.name,process_type=DEMULTIPLEX.values(), name=expectedName)   
     tot=0
     fclanel=[]
     filteredarts=[]
@@ -126,13 +145,11 @@ def sumreads(sample, summary):
     try:
         for inart in base_art.parent_process.all_inputs():
             if sample.name in [s.name for s in inart.samples]:
-                try:
-                    sq=lims.get_processes(type=SEQUENCING.values(), inputartifactlimsid=inart.id)[0]
-                except TypeError:
+                sq=lims.first(Process, type=SEQUENCING.values(), inputartifactlimsid=inart.id)
+                if sq is None:
                     logging.error("Did not manage to get sequencing process for artifact {0}".format(inart.id))
-                else:
-                    if "Read 2 Cycles" in sq.udf and sq.udf['Read 2 Cycles'] is not None:
-                        tot/=2
+                elif "Read 2 Cycles" in sq.udf and sq.udf['Read 2 Cycles'] is not None:
+                    tot/=2
                 break
     except AttributeError as e:
         print e
@@ -146,12 +163,7 @@ def sumreads(sample, summary):
     return tot
 
 def getParentInputs(art):
-    inp=set()
-    for i in art.parent_process.input_output_maps:
-        if i[1]['uri'].id==art.id:
-            inp.add(i[0]['uri'])
-
-    return inp
+    return set(art.parent_process.inputs_per_output(art.id))
     
 
 if __name__=="__main__":
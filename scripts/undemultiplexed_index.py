@@ -96,23 +96,24 @@ class RunQC():
     
     def _get_run(self, cont_name):
         """Getting parrent sequencing process and process type"""
-        miseq = lims.get_processes(udf = {'Reagent Cartridge ID' : cont_name},
-                                type = 'MiSeq Run (MiSeq) 4.0')
-        hiseq = lims.get_processes(udf = {'Flow Cell ID' : cont_name},
-                                type = 'Illumina Sequencing (Illumina SBS) 4.0')
-        hiseq_X10 = lims.get_processes(udf = {'Flow Cell ID' : cont_name},
-                                type = 'Illumina Sequencing (HiSeq X) 1.0')
+        miseq, hiseq, hiseq_X10 = lims.multi_query([
+            lims.query(Process, udf = {'Reagent Cartridge ID' : cont_name},
+                                type = 'MiSeq Run (MiSeq) 4.0').first,
+            lims.query(Process, udf = {'Flow Cell ID' : cont_name},
+                                type = 'Illumina Sequencing (Illumina SBS) 4.0').first,
+            lims.query(Process, udf = {'Flow Cell ID' : cont_name},
+                                type = 'Illumina Sequencing (HiSeq X) 1.0').first])
         if miseq:
-            self.seq_run = miseq[0]
+            self.seq_run = miseq
             self.run_type = 'MiSeq'
         elif hiseq:
-            self.seq_run = hiseq[0]
+            self.seq_run = hiseq
             try:
                 self.run_type = self.seq_run.udf['Flow Cell Version']
             except:
                 sys.exit("Missing field 'Flow Cell Version' in sequencing process")
         elif hiseq_X10:
-            self.seq_run = hiseq_X10[0]
+            self.seq_run = hiseq_X10
             self.run_type = 'HiSeqX10'
         else:
             sys.exit("run not found")
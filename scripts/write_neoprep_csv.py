@@ -30,6 +30,10 @@ def generate_data(step):
     proto_pattern=re.compile("([3,5]50)")
     #contents of the rows will be taken from both input and output artifacts
     data=""
+    #index sequences of the labels of the output analytes, looked up together
+    outs=lims.get_batch(list(set(io[1]['uri'] for io in step.input_output_maps)))
+    index=lims.get_reagent_index(names=set(out.reagent_labels[0] for out in outs
+                                           if out.type == "Analyte" and out.reagent_labels))
     for inout in step.input_output_maps:
         inp=inout[0]['uri']
         out=inout[1]['uri']
@@ -54,7 +58,9 @@ def generate_data(step):
             try:
                 #regent label (barcode) name and sequence
                 reglab_name=out.reagent_labels[0]
-                reglab_seq=lims.get_reagent_types(name=reglab_name)[0].sequence
+                reglab_seq=index.sequence(reglab_name)
+                if reglab_seq is None:
+                    raise KeyError(reglab_name)
             except:
                 logger.error("Cannot find the reagent label of output analyte {0}".format(out.id))
                 return None
@@ -48,6 +48,9 @@ setup(name='genologics',
       install_requires=[
           "requests"
       ],
+      extras_require={
+          "lxml": ["lxml"]
+      },
       entry_points="""
       # -*- Entry points: -*-
       """,
@@ -0,0 +1,127 @@
+"""Fake LIMS server for the tests, mounted on a Lims session as an adapter.
+
+Entities are served by URI path, listings are paginated with next-page
+URIs carrying the whole query like the real server's, and batch
+retrievals return the requested entities.
+"""
+import httplib
+from io import BytesIO
+import urllib
+import urlparse
+
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+
+from genologics.entities import Entity
+from genologics.xml_backend import ElementTree
+
+
+class FakeServer(requests.adapters.BaseAdapter):
+    "Adapter answering the calls of a Lims instance from in-memory data."
+
+    def __init__(self, lims, page_size=500):
+        super(FakeServer, self).__init__()
+        self.lims = lims
+        self.page_size = page_size
+        # XML of the entities, by URI without query
+        self.entities = dict()
+        # Functions of the query parameters returning the matching URIs,
+        # by listing path segment, e.g. 'processes'
+        self.listings = dict()
+        self.calls = []
+        # URIs requested by each batch retrieval
+        self.batches = []
+        # Number of batch responses whose connection drops after drop_after bytes
+        self.drops = 0
+        self.drop_after = 0
+        # Whether the batch responses after the first list the entities
+        # in reverse order
+        self.reorder = False
+        lims.request_session.mount('http://', self)
+
+    def add(self, klass, id, xml):
+        "Serve the XML of the entity of klass with the LIMS id."
+        uri = self.lims.get_uri(klass._URI, id)
+        self.entities[uri] = xml.format(uri=uri, id=id)
+        return uri
+
+    def calls_to(self, method, segment):
+        "Return the URLs of the calls with the method to the path segment."
+        return [url for m, url in self.calls
+                if m == method and urlparse.urlsplit(url).path.split('/')[3] == segment]
+
+    def send(self, request, **kwargs):
+        self.calls.append((request.method, request.url))
+        parts = urlparse.urlsplit(request.url)
+        path = urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+        segments = parts.path.split('/')
+        if request.method == 'POST' and segments[-2:] == ['batch', 'retrieve']:
+            return self._batch(request)
+        if request.method == 'GET' and len(segments) == 4:
+            return self._listing(request, segments[3], urlparse.parse_qs(parts.query))
+        if request.method == 'GET' and path in self.entities:
+            return self._response(request, 200, self.entities[path])
+        return self._response(request, 404, '<exc:exception xmlns:exc="http://genologics.com/ri/exception">'
+                              '<message>Not found</message></exc:exception>')
+
+    def _listing(self, request, segment, query):
+        start = int(query.pop('start-index', ['0'])[0])
+        uris = self.listings.get(segment, lambda query: [])(query)
+        tag = [lims_tag for klass, lims_tag in self._tags() if klass._URI == segment][0]
+        xml = ['<ri:list xmlns:ri="http://genologics.com/ri">']
+        for uri in uris[start:start + self.page_size]:
+            xml.append('<%s uri="%s" limsid="%s"/>' % (tag, uri, uri.split('/')[-1]))
+        if start + self.page_size < len(uris):
+            query['start-index'] = [str(start + self.page_size)]
+            xml.append('<next-page uri="%s?%s"/>' % (
+                self.lims.get_uri(segment), urllib.urlencode(query, doseq=True).replace('&', '&amp;')))
+        xml.append('</ri:list>')
+        return self._response(request, 200, ''.join(xml))
+
+    def _tags(self):
+        return [(k, self.lims._get_tag(k)) for k in Entity.__subclasses__() if k._URI]
+
+    def _batch(self, request):
+        root = ElementTree.fromstring(request.body)
+        xml = ['<ri:details xmlns:ri="http://genologics.com/ri">']
+        self.batches.append([link.attrib['uri'] for link in root.findall('link')])
+        links = root.findall('link')
+        if self.reorder and len(self.batches) > 1:
+            links.reverse()
+        for link in links:
+            uri = link.attrib['uri'].split('?')[0]
+            if uri in self.entities:
+                xml.append(self.entities[uri])
+        xml.append('</ri:details>')
+        response = self._response(request, 200, ''.join(xml))
+        if self.drops:
+            self.drops -= 1
+            response.raw = HTTPResponse(body=_DroppingFile(''.join(xml), self.drop_after),
+                                        preload_content=False)
+        return response
+
+    def _response(self, request, status, body):
+        response = requests.Response()
+        response.status_code = status
+        response.request = request
+        response.url = request.url
+        response.raw = HTTPResponse(body=BytesIO(body), preload_content=False)
+        return response
+
+    def close(self):
+        pass
+
+
+class _DroppingFile(BytesIO):
+    "Response body whose connection drops after the given number of bytes."
+
+    def __init__(self, data, limit):
+        BytesIO.__init__(self, data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise httplib.IncompleteRead('')
+        if size < 0 or self.tell() + size > self.limit:
+            size = self.limit - self.tell()
+        return BytesIO.read(self, size)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+from nose.tools import assert_equal, assert_true, assert_raises
+import datetime
+import os
+from genologics.xml_backend import ElementTree
+
+from genologics.entities import (Process, Processtype, Artifact, Sample, Step,
+                                 ReagentType, ReagentIndex, GenealogyGraph,
+                                 UdfSchema)
+from genologics.lims import Lims
+
+url = 'http://testgenologics.com:4040'
+tmp_dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'nose_tmp_output')
+
+process_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/p1" limsid="p1">
+<input-output-map>
+<input limsid="in1" uri="{url}/api/v2/artifacts/in1"/>
+<output limsid="out1" output-type="Analyte" output-generation-type="PerInput" uri="{url}/api/v2/artifacts/out1"/>
+</input-output-map>
+<input-output-map>
+<input limsid="in1" uri="{url}/api/v2/artifacts/in1"/>
+<output limsid="rf1" output-type="ResultFile" output-generation-type="PerInput" uri="{url}/api/v2/artifacts/rf1"/>
+</input-output-map>
+<input-output-map>
+<input limsid="in2" uri="{url}/api/v2/artifacts/in2"/>
+<output limsid="out2" output-type="Analyte" output-generation-type="PerInput" uri="{url}/api/v2/artifacts/out2"/>
+</input-output-map>
+<input-output-map>
+<input limsid="in1" uri="{url}/api/v2/artifacts/in1"/>
+<output limsid="srf" output-type="SharedResultFile" output-generation-type="PerAllInputs" uri="{url}/api/v2/artifacts/srf"/>
+</input-output-map>
+<input-output-map>
+<input limsid="in2" uri="{url}/api/v2/artifacts/in2"/>
+<output limsid="srf" output-type="SharedResultFile" output-generation-type="PerAllInputs" uri="{url}/api/v2/artifacts/srf"/>
+</input-output-map>
+</prc:process>""".format(url=url)
+
+
+class TestIOMap(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.process = Process(self.lims, id='p1')
+        self.process.root = ElementTree.fromstring(process_xml)
+
+    def test_input_output_maps(self):
+        """The tuples should follow the order of the XML"""
+        maps = self.process.input_output_maps
+        assert_equal(len(maps), 5)
+        assert_equal(maps[0][0]['limsid'], 'in1')
+        assert_equal(maps[2][1]['limsid'], 'out2')
+        assert_equal(maps[1][1]['output-type'], 'ResultFile')
+        assert_true(isinstance(maps[0][1]['uri'], Artifact))
+
+    def test_cached(self):
+        """The IOMap should be reused until the root is replaced"""
+        io_map = self.process.io_map
+        assert_true(self.process.io_map is io_map)
+        self.process.root = ElementTree.fromstring(process_xml)
+        assert_true(self.process.io_map is not io_map)
+
+    def test_outputs_per_input(self):
+        outs = self.process.outputs_per_input('in1')
+        assert_equal([a.id for a in outs], ['out1', 'rf1', 'srf'])
+        outs = self.process.outputs_per_input('in1', ResultFile=True)
+        assert_equal([a.id for a in outs], ['rf1'])
+        outs = self.process.outputs_per_input('in2', Analyte=True)
+        assert_equal([a.id for a in outs], ['out2'])
+        assert_equal(self.process.outputs_per_input('missing'), [])
+
+    def test_inputs_per_output(self):
+        ins = self.process.inputs_per_output('srf')
+        assert_equal([a.id for a in ins], ['in1', 'in2'])
+        ins = self.process.inputs_per_output('out2')
+        assert_equal([a.id for a in ins], ['in2'])
+
+    def test_input_artifact_list(self):
+        artifact = _artifact(self.lims, 'srf', 'p1')
+        assert_equal([a.id for a in artifact.input_artifact_list()], ['in1', 'in2'])
+        assert_equal(_artifact(self.lims, 'in1').input_artifact_list(), [])
+
+    def test_output_ids_by_type(self):
+        io_map = self.process.io_map
+        assert_equal(io_map.output_ids('SharedResultFile'), ['srf', 'srf'])
+        assert_equal(io_map.output_ids('Analyte'), ['out1', 'out2'])
+        assert_equal(io_map.output_ids('Missing'), [])
+
+    def test_all_outputs(self):
+        outs = self.process.all_outputs(unique=False, resolve=False)
+        assert_equal(len(outs), 5)
+        outs = self.process.all_outputs(unique=True, resolve=False)
+        assert_equal(sorted(a.id for a in outs), ['out1', 'out2', 'rf1', 'srf'])
+
+    def test_memoized_outputs(self):
+        """Artifact lists should be memoized until the root is replaced"""
+        outs = self.process.all_outputs(resolve=False)
+        outs.pop()
+        assert_equal(len(self.process.all_outputs(resolve=False)), 4)
+        memo = self.process._memo
+        self.process.root = ElementTree.fromstring(process_xml)
+        self.process.all_outputs(resolve=False)
+        assert_true(self.process._memo is not memo)
+
+
+def _artifact(lims, id, parent=None):
+    xml = '<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{0}/api/v2/artifacts/{1}" limsid="{1}"><type>Analyte</type>'.format(url, id)
+    if parent:
+        xml += '<parent-process uri="{0}/api/v2/processes/{1}" limsid="{1}"/>'.format(url, parent)
+    artifact = Artifact(lims, id=id)
+    artifact.root = ElementTree.fromstring(xml + '</art:artifact>')
+    return artifact
+
+def _process(lims, id, maps):
+    xml = '<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{0}/api/v2/processes/{1}" limsid="{1}"><type uri="{0}/api/v2/processtypes/1">Step</type><date-run>2015-01-01</date-run>'.format(url, id)
+    for inart, outart in maps:
+        xml += '<input-output-map><input limsid="{1}" uri="{0}/api/v2/artifacts/{1}"/><output limsid="{2}" output-type="Analyte" uri="{0}/api/v2/artifacts/{2}"/></input-output-map>'.format(url, inart, outart)
+    process = Process(lims, id=id)
+    process.root = ElementTree.fromstring(xml + '</prc:process>')
+    return process
+
+
+class TestGenealogyGraph(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        Processtype(self.lims, id='1').root = ElementTree.fromstring(
+            '<ptp:process-type xmlns:ptp="http://genologics.com/ri/processtype" name="Step"/>')
+        p1 = _process(self.lims, 'p1', [('a1', 'a2')])
+        p2 = _process(self.lims, 'p2', [('a2', 'a3'), ('b2', 'a3')])
+        qc = _process(self.lims, 'qc', [('a2', 'qc1')])
+        self.graph = GenealogyGraph(self.lims, processes_per_artifact={
+            'a1': [p1], 'a2': [p2, qc], 'a3': [], 'b2': [p2]})
+        self.graph.add_artifacts([_artifact(self.lims, 'a1'),
+                                  _artifact(self.lims, 'a2', 'p1'),
+                                  _artifact(self.lims, 'a3', 'p2'),
+                                  _artifact(self.lims, 'b2')])
+        self.graph.sample_artifacts['S'] = set(['a1', 'a2', 'a3'])
+
+    def test_history(self):
+        history, hist_list = self.graph.history('S', 'a3')
+        assert_equal(hist_list, ['a2', 'a1'])
+        assert_equal(history['a2']['p2']['outart'], 'a3')
+        assert_equal(history['a2']['qc']['outart'], None)
+        assert_equal(history['a1']['p1']['outart'], 'a2')
+        assert_equal(history['a1']['p1']['name'], 'Step')
+
+    def test_history_from_input(self):
+        history, hist_list = self.graph.history('S', 'qc1', 'a2')
+        assert_equal(hist_list, ['a2', 'a1'])
+        assert_equal(history['a2']['qc']['outart'], 'qc1')
+        assert_equal(history['a2']['p2']['outart'], None)
+
+    def test_ancestors_descendants(self):
+        assert_equal(sorted(self.graph.ancestors('a3')), ['a1', 'a2', 'b2'])
+        assert_equal(self.graph.descendants('a1'), ['a2', 'a3', 'qc1'])
+
+    def test_sample_histories(self):
+        histories = self.graph.sample_histories({'S': 'a3'})
+        assert_equal(histories['S'].history_list, ['a2', 'a1'])
+        assert_equal(histories['S'].history['a1']['p1']['outart'], 'a2')
+        assert_equal(sorted(self.graph.processes_per_artifact()), ['a1', 'a2', 'a3', 'b2'])
+
+
+class TestLazyEntities(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_reagent_type_sequence(self):
+        reagent_type = ReagentType(self.lims, id='r1')
+        assert_equal(reagent_type.root, None)
+        reagent_type.root = ElementTree.fromstring(
+            '<rtp:reagent-type xmlns:rtp="http://genologics.com/ri/reagenttype" name="A001">'
+            '<special-type name="Index"><attribute name="Sequence" value="ACGT"/></special-type>'
+            '</rtp:reagent-type>')
+        assert_equal(reagent_type.sequence, 'ACGT')
+
+    def test_step_actions(self):
+        step = Step(self.lims, id='s1')
+        assert_equal(step.root, None)
+        assert_true(step.actions is step.actions)
+        assert_equal(step.actions.uri, url + '/api/v2/steps/s1/actions')
+        assert_equal(step.actions.root, None)
+
+
+class TestReagentIndex(object):
+    def setUp(self):
+        self.index = ReagentIndex({'A001': 'ACGT', 'A002': 'TTGA'})
+        self.path = os.path.join(tmp_dir_path, 'reagent_index.json')
+        if not os.path.isdir(tmp_dir_path):
+            os.mkdir(tmp_dir_path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_lookup(self):
+        assert_equal(self.index.sequence('A002'), 'TTGA')
+        assert_equal(self.index.name('ACGT'), 'A001')
+        assert_equal(self.index.sequence('missing'), None)
+
+    def test_file(self):
+        self.index.write(self.path)
+        index = ReagentIndex.read(self.path)
+        assert_equal(index.sequences, self.index.sequences)
+        assert_equal(ReagentIndex.read(self.path, max_age=-1), None)
+        assert_equal(ReagentIndex.read(self.path + '.missing'), None)
+
+    def test_file_server(self):
+        self.index.write(self.path, baseuri=url)
+        assert_equal(ReagentIndex.read(self.path, baseuri=url).sequences, self.index.sequences)
+        assert_equal(ReagentIndex.read(self.path, baseuri='https://other.example.com/'), None)
+
+
+class TestUdfDictionary(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.sample = Sample(self.lims, id='s1')
+        self.sample.root = ElementTree.fromstring(
+            '<smp:sample xmlns:smp="http://genologics.com/ri/sample" xmlns:udf="http://genologics.com/ri/userdefined">'
+            '<udf:field type="Numeric" name="Conc">2.5</udf:field>'
+            '<udf:field type="Numeric" name="Count">3</udf:field>'
+            '<udf:field type="Boolean" name="Done">true</udf:field>'
+            '<udf:field type="Date" name="Received">2015-02-03</udf:field>'
+            '<udf:field type="String" name="Empty"></udf:field>'
+            '</smp:sample>')
+
+    def test_parse(self):
+        udf = self.sample.udf
+        assert_equal(udf['Conc'], 2.5)
+        assert_equal(udf['Count'], 3)
+        assert_equal(udf['Done'], True)
+        assert_equal(udf['Received'], datetime.date(2015, 2, 3))
+        assert_equal(udf['Empty'], None)
+
+    def test_set(self):
+        udf = self.sample.udf
+        udf['Conc'] = 4
+        assert_equal(udf._elems[0].text, u'4')
+        assert_raises(TypeError, udf.__setitem__, 'Conc', 'high')
+        assert_raises(TypeError, udf.__setitem__, 'Done', 'yes')
+
+    def test_schema(self):
+        schema = UdfSchema()
+        schema.add(None, 'Sample', 'Volume', 'Numeric')
+        self.lims.udf_schema = schema
+        udf = self.sample.udf
+        assert_raises(TypeError, udf.__setitem__, 'Volume', 'a lot')
+        udf['Volume'] = 10
+        node = self.sample.root.findall('{http://genologics.com/ri/userdefined}field')[-1]
+        assert_equal((node.attrib['type'], node.text), ('Numeric', u'10'))
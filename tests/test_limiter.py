@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+from nose.tools import assert_equal, assert_true
+import threading
+import time
+
+from genologics.limiter import Limiter
+from genologics.lims import Lims
+
+
+class TestLimiter(object):
+    def test_unlimited(self):
+        limiter = Limiter()
+        for i in range(100):
+            assert_true(limiter.acquire())
+        assert_equal(limiter.in_flight, 100)
+
+    def test_rate(self):
+        limiter = Limiter(rate=1000, burst=5)
+        start = time.time()
+        for i in range(10):
+            limiter.acquire()
+            limiter.release()
+        assert_true(time.time() - start >= 0.004)
+        assert_equal(limiter.stats['calls'], 10)
+        assert_true(limiter.stats['delayed'] > 0)
+
+    def test_max_in_flight(self):
+        limiter = Limiter(max_in_flight=1)
+        assert_true(limiter.acquire())
+        assert_equal(limiter.acquire(deadline=time.time() + 0.01), False)
+        limiter.release()
+        assert_true(limiter.acquire(deadline=time.time() + 0.01))
+
+    def test_priority(self):
+        limiter = Limiter(max_in_flight=1)
+        limiter.acquire()
+        order = []
+        def call(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+            limiter.release()
+        bulk = threading.Thread(target=call, args=(Limiter.BULK,))
+        bulk.start()
+        time.sleep(0.05)
+        interactive = threading.Thread(target=call, args=(Limiter.INTERACTIVE,))
+        interactive.start()
+        time.sleep(0.05)
+        limiter.release()
+        bulk.join()
+        interactive.join()
+        assert_equal(order, [Limiter.INTERACTIVE, Limiter.BULK])
+
+
+class TestLimsLimits(object):
+    def test_unlimited(self):
+        lims = Lims('http://lims', 'test', 'password')
+        assert_equal((lims.limiter.rate, lims.limiter.max_in_flight), (None, None))
+
+    def test_given(self):
+        lims = Lims('http://lims', 'test', 'password', rate_limit=2.5, max_in_flight=2)
+        assert_equal((lims.limiter.rate, lims.limiter.max_in_flight), (2.5, 2))
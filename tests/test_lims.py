@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+from nose.tools import assert_equal, assert_true, assert_raises
+import json
+from io import BytesIO
+import os
+import threading
+import time
+import zlib
+
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+
+from genologics.entities import (Processtype, Process, Project, Artifact, ReagentType, Sample,
+                                 GenealogyGraph)
+from genologics import xml_backend
+from genologics.limiter import Limiter
+from genologics.lims import Lims, Query
+from fake_server import FakeServer
+
+url = 'http://testgenologics.com:4040'
+tmp_dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'nose_tmp_output')
+
+
+class TestConfigSnapshot(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.path = os.path.join(tmp_dir_path, 'config_snapshot.json')
+        if not os.path.isdir(tmp_dir_path):
+            os.mkdir(tmp_dir_path)
+        self.uri = url + '/api/v2/processtypes/1'
+        self.snapshot = dict(version=Lims.CONFIG_SNAPSHOT_VERSION,
+                             created=time.time(),
+                             baseuri=self.lims.baseuri,
+                             api_version=self.lims.VERSION,
+                             entities=[('Processtype', self.uri,
+                                        '<ptp:process-type xmlns:ptp="http://genologics.com/ri/processtype" name="Step"/>')])
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self):
+        with open(self.path, 'w') as outfile:
+            json.dump(self.snapshot, outfile)
+
+    def test_warm_start(self):
+        self._write()
+        assert_true(self.lims.load_config_snapshot(self.path))
+        assert_equal(Processtype(self.lims, uri=self.uri).name, 'Step')
+
+    def test_stale(self):
+        self.snapshot['created'] = time.time() - 3600
+        self._write()
+        assert_equal(self.lims._read_config_snapshot(self.path, max_age=60), None)
+        self.snapshot['baseuri'] = 'http://other.com/'
+        self._write()
+        assert_equal(self.lims._read_config_snapshot(self.path), None)
+
+
+class TestQuery(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_filters(self):
+        query = self.lims.get_processes(type='Step', lazy=True)
+        assert_true(isinstance(query, Query))
+        query2 = query.filter(udf={'Flow Cell ID': 'FC1'}).since('2015-01-01T00:00:00Z')
+        assert_equal(query.params, {'type': 'Step'})
+        assert_equal(query2.params, {'type': 'Step',
+                                     'udf.Flow Cell ID': 'FC1',
+                                     'last-modified': '2015-01-01T00:00:00Z'})
+        assert_equal(query2.klass, Process)
+
+    def test_empty_slice(self):
+        assert_equal(self.lims.query(Process)[5:5], [])
+
+    def _serve(self):
+        server = FakeServer(self.lims, page_size=500)
+        uris = [self.lims.get_uri('samples', 'S%i' % i) for i in xrange(1234)]
+        for id in ('S0', 'S1', 'S2'):
+            server.add(Sample, id, '<smp:sample xmlns:smp="http://genologics.com/ri/sample" '
+                                   'uri="{uri}" limsid="{id}"><name>{id}</name></smp:sample>')
+        server.listings['samples'] = lambda query: \
+            uris[:3] if query.get('name') == ['few'] else uris
+        return server, uris
+
+    def test_iterate(self):
+        server, uris = self._serve()
+        assert_equal([s.uri for s in self.lims.query(Sample)], uris)
+        assert_equal(len(server.calls), 3)
+
+    def test_slice(self):
+        server, uris = self._serve()
+        query = self.lims.query(Sample)
+        assert_equal([s.uri for s in query[498:503]], uris[498:503])
+        assert_true('start-index=498' in server.calls[0][1])
+        assert_equal(query[700].uri, uris[700])
+        assert_equal(self.lims.get_samples(start_index='500', lazy=True)[3].uri, uris[503])
+
+    def test_count_first(self):
+        server, uris = self._serve()
+        query = self.lims.get_samples(start_index=500, lazy=True)
+        assert_equal(query.count(), 734)
+        assert_equal(query.count(), len(list(query)))
+        assert_equal(self.lims.query(Sample).first().uri, uris[0])
+        assert_equal(query.first().uri, uris[500])
+
+    def test_resolve(self):
+        server, uris = self._serve()
+        samples = self.lims.get_samples(name='few', lazy=True).resolve()
+        assert_equal([s.name for s in samples], ['S0', 'S1', 'S2'])
+        assert_equal(len(server.batches), 1)
+        assert_raises(ValueError, self.lims.get_artifacts, resolve=True, lazy=True)
+
+
+class TestSplitParams(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_short(self):
+        params = {'inputartifactlimsid': ['2-1', '2-2'], 'type': 'Step'}
+        assert_equal(self.lims._split_params(Process, params), [params])
+
+    def test_long(self):
+        ids = ['2-%d' % i for i in xrange(2000)]
+        params = {'inputartifactlimsid': ids, 'type': 'Step'}
+        chunks = self.lims._split_params(Process, params)
+        assert_true(len(chunks) > 1)
+        uri = self.lims.get_uri(Process._URI)
+        merged = []
+        for chunk in chunks:
+            assert_true(self.lims._url_length(uri, chunk) <= Lims.MAX_URL_LENGTH)
+            assert_equal(chunk['type'], 'Step')
+            merged.extend(chunk['inputartifactlimsid'])
+        assert_equal(merged, ids)
+
+    def test_multi_page_chunks(self):
+        server = FakeServer(self.lims, page_size=20)
+        ids = ['SAMPLE-LIMSID-%04d' % i for i in xrange(300)]
+        server.listings['artifacts'] = lambda query: [
+            self.lims.get_uri('artifacts', '%s-PA%d' % (id, i))
+            for id in query.get('samplelimsid', []) for i in range(2)]
+        artifacts = self.lims.get_artifacts(samplelimsid=ids)
+        assert_equal(len(artifacts), 600)
+        urls = server.calls_to('GET', 'artifacts')
+        assert_true(len(urls) > len(self.lims._split_params(Artifact, {'samplelimsid': ids})))
+        assert_true(all(len(u) <= Lims.MAX_URL_LENGTH for u in urls))
+
+
+class TestIterResponse(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_children(self):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = HTTPResponse(body=BytesIO(
+            b'<art:details xmlns:art="http://genologics.com/ri/artifact">'
+            b'<art:artifact uri="a1"><name>A</name></art:artifact>'
+            b'<art:artifact uri="a2"><name>B</name></art:artifact>'
+            b'</art:details>'), preload_content=False)
+        nodes = list(self.lims.iter_response(response))
+        assert_equal([n.attrib['uri'] for n in nodes], ['a1', 'a2'])
+        assert_equal(nodes[1].find('name').text, 'B')
+
+    def test_compressed(self):
+        body = ('<art:details xmlns:art="http://genologics.com/ri/artifact">'
+                + '<art:artifact uri="a"><name>A</name></art:artifact>' * 100
+                + '</art:details>')
+        compressed = zlib.compress(body)
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['content-encoding'] = 'deflate'
+        response.raw = HTTPResponse(body=BytesIO(compressed), preload_content=False,
+                                    headers={'content-encoding': 'deflate'})
+        assert_equal(len(list(self.lims.iter_response(response))), 100)
+        record = self.lims.transfers[-1]
+        assert_equal((record['wire'], record['decoded']), (len(compressed), len(body)))
+        assert_equal(self.lims.transfer_totals['calls'], 1)
+
+
+class TestParseBatch(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.lims.PARSE_CHUNK_SIZE = 100
+        self.content = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<smp:details xmlns:smp="http://genologics.com/ri/sample">'
+                        + ''.join('<smp:sample uri="s%i"><name>Sample %i</name>'
+                                  '<artifact uri="a%i"/></smp:sample>' % (i, i, i)
+                                  for i in range(10))
+                        + '</smp:details>')
+
+    def test_split(self):
+        chunks = self.lims._split_batch(self.content)
+        assert_true(len(chunks) > 1)
+        assert_true(all(c.endswith('</smp:details>') for c in chunks))
+
+    def test_parse(self):
+        self.lims.PARSE_WORKERS = 4
+        nodes = self.lims._parse_batch(self.content)
+        assert_equal([n.attrib['uri'] for n in nodes], ['s%i' % i for i in range(10)])
+        assert_equal(nodes[9].find('name').text, 'Sample 9')
+
+    def test_cdata(self):
+        content = self.content.replace(
+            '<name>Sample 3</name>',
+            '<name><![CDATA[</smp:sample><smp:sample uri="x">]]></name>')
+        self.lims.PARSE_WORKERS = 4
+        assert_equal(self.lims._split_batch(content), [content])
+        nodes = self.lims._parse_batch(content)
+        assert_equal([n.attrib['uri'] for n in nodes], ['s%i' % i for i in range(10)])
+        assert_equal(nodes[3].find('name').text, '</smp:sample><smp:sample uri="x">')
+
+    def test_nested(self):
+        content = self.content.replace(
+            '<name>Sample 1</name>',
+            '<smp:sample>' + 'x' * 100 + '</smp:sample><name>Sample 1</name>')
+        self.lims.PARSE_WORKERS = 4
+        chunks = self.lims._split_batch(content)
+        assert_true(len(chunks) > 1)
+        nodes = self.lims._parse_batch(content)
+        assert_equal([n.attrib['uri'] for n in nodes], ['s%i' % i for i in range(10)])
+
+    def test_streams_without_lxml(self):
+        server = FakeServer(self.lims)
+        uris = [server.add(Sample, 'S%i' % i,
+                           '<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{uri}"/>')
+                for i in range(3)]
+        self.lims.PARSE_WORKERS = 4
+        self.lims._parse_batch = None
+        backend = xml_backend.LXML
+        xml_backend.LXML = False
+        try:
+            samples = self.lims.get_batch([Sample(self.lims, uri=uri) for uri in uris])
+        finally:
+            xml_backend.LXML = backend
+        assert_equal([s.uri for s in samples], uris)
+
+
+class TestTransport(object):
+    def setUp(self):
+        self.lims = Lims('https://testgenologics.com:4040', username='test', password='password')
+
+    def test_deadline(self):
+        assert_equal(self.lims._timeout(), (Lims.CONNECT_TIMEOUT, Lims.READ_TIMEOUT))
+        with self.lims.deadline(5):
+            connect, read = self.lims._timeout()
+            assert_true(read <= 5)
+            with self.lims.deadline(60):
+                assert_true(self.lims._timeout()[1] <= 5)
+        with self.lims.deadline(-1):
+            assert_raises(requests.exceptions.Timeout, self.lims.get, self.lims.get_uri('samples'))
+            assert_raises(requests.exceptions.Timeout, self.lims._map,
+                          lambda i: self.lims._timeout(), [1, 2])
+        assert_equal(self.lims._local.deadline, None)
+
+    def test_pool_stats(self):
+        self.lims.adapter.poolmanager.connection_from_url(self.lims.baseuri)
+        stats = self.lims.pool_stats()[('https', 'testgenologics.com', 4040)]
+        assert_equal(stats['size'], Lims.POOL_SIZE)
+        assert_equal((stats['in_use'], stats['idle'], stats['requests']), (0, 0, 0))
+
+
+class _Adapter(requests.adapters.BaseAdapter):
+    """Adapter answering with the given status codes, or raising the given
+    exceptions, recording the requests."""
+
+    def __init__(self, statuses, cookie=None, delay=0):
+        super(_Adapter, self).__init__()
+        self.statuses = list(statuses)
+        self.cookie = cookie
+        self.delay = delay
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        time.sleep(self.delay)
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        response = requests.Response()
+        response.status_code = status
+        response.request = request
+        response.url = request.url
+        response.raw = HTTPResponse(body=BytesIO(b'<ri:links xmlns:ri="http://genologics.com/ri"/>'),
+                                    preload_content=False)
+        if self.cookie and 'Authorization' in request.headers:
+            response.raw._original_response = _Message(
+                'JSESSIONID=%s; Path=/' % self.cookie)
+            requests.cookies.extract_cookies_to_jar(response.cookies, request,
+                                                    response.raw)
+        return response
+
+    def close(self):
+        pass
+
+
+class _Message(object):
+    "Minimal httplib response with a Set-Cookie header."
+
+    def __init__(self, cookie):
+        self.msg = self
+        self.cookie = cookie
+
+    def getheaders(self, name):
+        return [self.cookie] if name.lower() == 'set-cookie' else []
+
+    def isclosed(self):
+        return False
+
+
+class TestSessionCookie(object):
+    def setUp(self):
+        self.path = os.path.join(tmp_dir_path, 'cookies.json')
+        if not os.path.isdir(tmp_dir_path):
+            os.mkdir(tmp_dir_path)
+        self.lims = Lims(url, username='test', password='password', cookie_file=self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _mount(self, lims, adapter):
+        lims.request_session.mount('http://', adapter)
+        return adapter
+
+    def test_reuse(self):
+        adapter = self._mount(self.lims, _Adapter([200, 200, 401, 200], cookie='abc'))
+        uri = self.lims.get_uri('samples')
+        self.lims.get(uri)
+        self.lims.get(uri)
+        assert_true('Authorization' in adapter.requests[0].headers)
+        assert_true('Authorization' not in adapter.requests[1].headers)
+        assert_equal(adapter.requests[1].headers['Cookie'], 'JSESSIONID=abc')
+        self.lims.get(uri)
+        assert_true('Authorization' in adapter.requests[3].headers)
+
+    def test_persisted(self):
+        open(self.path, 'w').close()
+        os.chmod(self.path, 0644)
+        self._mount(self.lims, _Adapter([200], cookie='abc'))
+        self.lims.get(self.lims.get_uri('samples'))
+        assert_equal(os.stat(self.path).st_mode & 0777, 0600)
+        lims = Lims(url, username='test', password='password', cookie_file=self.path)
+        assert_equal(lims.request_session.cookies.get('JSESSIONID'), 'abc')
+        lims = Lims(url, username='other', password='password', cookie_file=self.path)
+        assert_equal(len(lims.request_session.cookies), 0)
+
+
+class TestRetry(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.lims.RETRY_BACKOFF = 0
+        self.uri = self.lims.get_uri('samples')
+
+    def _mount(self, statuses):
+        adapter = _Adapter(statuses)
+        self.lims.request_session.mount('http://', adapter)
+        return adapter
+
+    def test_get(self):
+        adapter = self._mount([503, 502, 200])
+        self.lims.get(self.uri)
+        assert_equal(len(adapter.requests), 3)
+        stats = self.lims.retry_stats
+        assert_equal((stats['calls'], stats['retries'], stats['recovered']), (1, 2, 1))
+        assert_equal(stats['reasons'], {503: 1, 502: 1})
+
+    def test_exhausted(self):
+        adapter = self._mount([503] * (Lims.RETRIES + 1))
+        assert_raises(requests.exceptions.HTTPError, self.lims.get, self.uri)
+        assert_equal(len(adapter.requests), Lims.RETRIES + 1)
+        assert_equal(self.lims.retry_stats['failed'], 1)
+
+    def test_post(self):
+        adapter = self._mount([503, 200])
+        assert_raises(requests.exceptions.HTTPError, self.lims.post, self.uri, '<x/>')
+        assert_equal(len(adapter.requests), 1)
+
+    def test_dropped(self):
+        adapter = self._mount([requests.exceptions.ChunkedEncodingError(),
+                               requests.exceptions.ReadTimeout(), 200])
+        self.lims.get(self.uri)
+        assert_equal(len(adapter.requests), 3)
+        assert_equal(self.lims.retry_stats['reasons'], {'connection': 2})
+
+    def test_batch_dropped(self):
+        server = FakeServer(self.lims)
+        uris = [server.add(Sample, 'S%i' % i,
+                           '<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{uri}" '
+                           'limsid="{id}"><name>{id}</name></smp:sample>')
+                for i in range(10)]
+        server.drops = 2
+        server.drop_after = 400
+        samples = self.lims.get_batch([Sample(self.lims, uri=uri) for uri in uris])
+        assert_equal([s.name for s in samples], ['S%i' % i for i in range(10)])
+        assert_equal(len(server.batches), 3)
+        assert_equal(self.lims.retry_stats['recovered'], 1)
+        server.drops = Lims.RETRIES + 1
+        assert_raises(requests.exceptions.ChunkedEncodingError,
+                      self.lims.get_batch, samples)
+
+    def test_batch_dropped_reordered(self):
+        server = FakeServer(self.lims)
+        uris = [server.add(Sample, 'S%i' % i,
+                           '<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{uri}" '
+                           'limsid="{id}"><name>{id}</name></smp:sample>')
+                for i in range(10)]
+        server.drops = 1
+        server.drop_after = 400
+        server.reorder = True
+        samples = self.lims.get_batch([Sample(self.lims, uri=uri) for uri in uris])
+        assert_equal(len(server.batches), 2)
+        assert_equal(sorted(s.name for s in samples), sorted('S%i' % i for i in range(10)))
+
+    def test_stream_admission(self):
+        server = FakeServer(self.lims)
+        uris = [server.add(Sample, 'S%i' % i,
+                           '<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{uri}"/>')
+                for i in range(3)]
+        data = '<ri:links xmlns:ri="http://genologics.com/ri">%s</ri:links>' % ''.join(
+            '<link uri="%s"/>' % uri for uri in uris)
+        nodes = self.lims.post_iter(self.lims.get_uri('samples', 'batch/retrieve'), data)
+        nodes.next()
+        # Held until the streamed body is read
+        assert_equal(self.lims.limiter.in_flight, 1)
+        assert_equal(len(list(nodes)), 2)
+        assert_equal(self.lims.limiter.in_flight, 0)
+        server.drops = 1
+        self.lims.get_batch([Sample(self.lims, uri=uri) for uri in uris])
+        assert_equal(self.lims.limiter.in_flight, 0)
+
+    def test_retry_after(self):
+        response = requests.Response()
+        response.headers['retry-after'] = '2'
+        assert_equal(self.lims._retry_delay(0, response), 2)
+        response.headers['retry-after'] = str(Lims.RETRY_MAX_DELAY + 1)
+        assert_equal(self.lims._retry_delay(0, response), None)
+
+
+class TestSharedGet(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+
+    def test_coalesced(self):
+        adapter = _Adapter([200], delay=0.1)
+        self.lims.request_session.mount('http://', adapter)
+        projects = self.lims._map(lambda i: Project(self.lims, id='P1'), range(8))
+        assert_true(all(p is projects[0] for p in projects))
+        self.lims._map(lambda p: p.get(), projects)
+        assert_equal(len(adapter.requests), 1)
+        assert_equal(self.lims._flights, {})
+        # Calls arriving after the shared one find the root set
+        self.lims._map(lambda p: p.get(), projects)
+        assert_equal(len(adapter.requests), 1)
+
+    def test_forced(self):
+        adapter = _Adapter([200, 200], delay=0.1)
+        self.lims.request_session.mount('http://', adapter)
+        project = Project(self.lims, id='P1')
+        thread = threading.Thread(target=project.get)
+        thread.start()
+        time.sleep(0.05)
+        project.get(force=True)
+        thread.join()
+        assert_equal(len(adapter.requests), 2)
+        assert_true(project.root is not None)
+
+    def test_canonical_uri(self):
+        assert_equal(self.lims._canonical_uri('HTTP://Host/api/v2/artifacts/A1?b=2&a=1'),
+                     'http://host/api/v2/artifacts/A1?a=1&b=2')
+
+
+class TestGenealogy(object):
+    """Diamond a1 -> p1 -> (a2, a3) -> p2 -> a4, pooling a2 and a3,
+    and a cycle a4 -> p3 -> a1."""
+
+    PROCESSES = {'p1': [('a1', 'a2'), ('a1', 'a3')],
+                 'p2': [('a2', 'a4'), ('a3', 'a4')],
+                 'p3': [('a4', 'a1')]}
+
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.server = FakeServer(self.lims)
+        parents = dict()
+        for id, maps in self.PROCESSES.iteritems():
+            xml = '<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{uri}" limsid="{id}">'
+            for input, output in maps:
+                xml += ('<input-output-map><input limsid="%s" uri="%s"/>'
+                        '<output limsid="%s" output-type="Analyte" uri="%s"/></input-output-map>'
+                        % (input, self.lims.get_uri('artifacts', input),
+                           output, self.lims.get_uri('artifacts', output)))
+                parents[output] = id
+            self.server.add(Process, id, xml + '</prc:process>')
+        for id in ('a1', 'a2', 'a3', 'a4'):
+            self.server.add(Artifact, id,
+                            '<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{uri}" limsid="{id}">'
+                            '<parent-process uri="%s" limsid="%s"/></art:artifact>'
+                            % (self.lims.get_uri('processes', parents[id]), parents[id]))
+        def processes(query):
+            ids = query.get('inputartifactlimsid', [])
+            return [self.lims.get_uri('processes', p) for p, maps in sorted(self.PROCESSES.items())
+                    if any(i in ids for i, o in maps)]
+        self.server.listings['processes'] = processes
+
+    def test_descendants(self):
+        result = self.lims.descendants([Artifact(self.lims, id='a1')])
+        assert_equal(sorted(a.id for a in result[:2]), ['a2', 'a3'])
+        assert_equal([a.id for a in result[2:]], ['a4'])
+        assert_true(all(a.root is not None for a in result))
+        # One listing per frontier: a1, (a2, a3), a4 whose only output is seen
+        listings = [u for u in self.server.calls_to('GET', 'processes') if '?' in u]
+        assert_equal(len(listings), 3)
+        assert_equal(len(self.server.calls_to('POST', 'artifacts')), 1)
+
+    def test_descendants_depth(self):
+        result = self.lims.descendants([Artifact(self.lims, id='a1')], depth=1)
+        assert_equal(sorted(a.id for a in result), ['a2', 'a3'])
+
+    def test_ancestors(self):
+        result = self.lims.ancestors([Artifact(self.lims, id='a4')])
+        assert_equal(sorted(a.id for a in result[:2]), ['a2', 'a3'])
+        assert_equal([a.id for a in result[2:]], ['a1'])
+        # One batch per frontier: a4, (a2, a3), a1; a1's parent input a4 is seen
+        assert_equal(len(self.server.calls_to('POST', 'artifacts')), 3)
+
+    def test_ancestors_depth(self):
+        result = self.lims.ancestors([Artifact(self.lims, id='a4')], depth=1)
+        assert_equal(sorted(a.id for a in result), ['a2', 'a3'])
+
+    def test_graph_parents(self):
+        artifacts = self.lims.get_batch([Artifact(self.lims, id=id) for id in ('a1', 'a2', 'a4')])
+        mapped = []
+        map = self.lims._map
+        def record(function, items):
+            mapped.append(len(items))
+            return map(function, items)
+        self.lims._map = record
+        graph = GenealogyGraph(self.lims)
+        graph.add_artifacts(artifacts)
+        assert_equal(sorted(graph.processes), ['p1', 'p2', 'p3'])
+        assert_true(all(p.root is not None for p in graph.processes.values()))
+        # The parent processes are fetched together on concurrent threads
+        assert_equal(mapped, [3])
+
+
+class TestReagentIndexNames(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.server = FakeServer(self.lims)
+        uris = dict()
+        for id, name, sequence in (('r1', 'A001', 'ACGT'), ('r2', 'A002', 'TTGA'),
+                                   ('r3', 'A003', 'GGCA')):
+            uris[name] = self.server.add(ReagentType, id,
+                '<rtp:reagent-type xmlns:rtp="http://genologics.com/ri/reagenttype" uri="{uri}" name="%s">'
+                '<special-type name="Index"><attribute name="Sequence" value="%s"/></special-type>'
+                '</rtp:reagent-type>' % (name, sequence))
+        self.server.listings['reagenttypes'] = lambda query: \
+            [uris[n] for n in query.get('name', sorted(uris))]
+
+    def test_names(self):
+        index = self.lims.get_reagent_index(names=['A002'])
+        assert_equal(index.sequences, {'A002': 'TTGA'})
+        assert_equal(len(self.server.calls), 2)
+        assert_equal(self.lims._reagent_index, None)
+
+    def test_artifact(self):
+        uri = self.server.add(Artifact, 'a1',
+            '<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{uri}" limsid="{id}">'
+            '<reagent-label name="A001"/><reagent-label name="A003"/></art:artifact>')
+        artifact = Artifact(self.lims, uri=uri)
+        assert_equal(artifact.reagent_sequences, ['ACGT', 'GGCA'])
+        # The artifact, one listing of its two labels, and their two types
+        assert_equal(len(self.server.calls), 4)
+        assert_equal(sorted(u.split('/')[-1] for u in self.server.calls_to('GET', 'reagenttypes')),
+                     ['r1', 'r3', 'reagenttypes?name=A001&name=A003'])
+
+
+class TestCount(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.server = FakeServer(self.lims, page_size=500)
+        self.uris = [self.lims.get_uri('samples', 'S%i' % i) for i in xrange(1234)]
+        self.server.listings['samples'] = lambda query: \
+            self.uris if query.get('name') != ['none'] else []
+
+    def test_multi_page(self):
+        assert_equal(self.lims.count(Sample), 1234)
+        # Pages 2 and 3 and at most one page past the end
+        assert_true(len(self.server.calls) <= 4)
+
+    def test_single_page(self):
+        self.server.page_size = 2000
+        assert_equal(self.lims.count(Sample), 1234)
+        assert_equal(len(self.server.calls), 1)
+
+    def test_bulk_windows(self):
+        priorities = []
+        acquire = self.lims.limiter.acquire
+        def record(priority, deadline=None):
+            priorities.append(priority)
+            return acquire(priority, deadline)
+        self.lims.limiter.acquire = record
+        self.lims.count(Sample)
+        assert_equal(priorities[0], Limiter.INTERACTIVE)
+        assert_equal(set(priorities[1:]), set([Limiter.BULK]))
+
+    def test_empty(self):
+        assert_equal(self.lims.count(Sample, name='none'), 0)
+        assert_equal(self.lims.first(Sample, name='none'), None)
+        assert_equal(self.lims.exists(Sample, name='none'), False)
+
+    def test_start_index(self):
+        assert_equal(self.lims.count(Sample, start_index=1000), 234)
+        assert_equal(len(self.server.calls), 1)
+
+    def test_first(self):
+        assert_equal(self.lims.first(Sample).uri, self.uris[0])
+        assert_true(self.lims.exists(Sample))
+        assert_equal(len(self.server.calls), 2)
+
+
+class TestMultiQuery(object):
+    def test_callables(self):
+        lims = Lims(url, username='test', password='password')
+        server = FakeServer(lims, page_size=2)
+        server.listings['samples'] = lambda query: [
+            lims.get_uri('samples', '%s%i' % (query['name'][0], i)) for i in range(5)]
+        samples, first, count = lims.multi_query([lims.query(Sample, name='A'),
+                                                  lims.query(Sample, name='B').first,
+                                                  lims.query(Sample, name='C').count])
+        assert_equal(len(samples), 5)
+        assert_equal(first.id, 'B0')
+        assert_equal(count, 5)
+        # Only the first page is fetched for first
+        assert_equal(len([u for m, u in server.calls if 'name=B' in u]), 1)
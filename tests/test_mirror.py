@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+from nose.tools import assert_equal, assert_raises
+
+from genologics.xml_backend import ElementTree
+from genologics.entities import Project, Sample, Artifact, Process
+from genologics.lims import Lims
+from genologics.mirror import Mirror
+
+url = 'http://testgenologics.com:4040/api/v2'
+
+
+def _entity(lims, klass, id, xml):
+    instance = klass(lims, uri='{0}/{1}/{2}'.format(url, klass._URI, id))
+    instance.root = ElementTree.fromstring(xml.format(url=url))
+    return instance
+
+
+class TestMirror(object):
+    def setUp(self):
+        self.lims = Lims('http://testgenologics.com:4040', username='test', password='password')
+        self.mirror = Mirror(self.lims)
+        project = _entity(self.lims, Project, 'P1',
+            '<prj:project xmlns:prj="http://genologics.com/ri/project"><name>P</name>'
+            '<open-date>2015-01-01</open-date></prj:project>')
+        sample = _entity(self.lims, Sample, 'S1',
+            '<smp:sample xmlns:smp="http://genologics.com/ri/sample"><name>S</name>'
+            '<project uri="{url}/projects/P1"/></smp:sample>')
+        process = _entity(self.lims, Process, 'SEQ',
+            '<prc:process xmlns:prc="http://genologics.com/ri/process">'
+            '<type uri="{url}/processtypes/1">Sequencing</type><date-run>2015-02-01</date-run>'
+            '<input-output-map><input limsid="L1" uri="{url}/artifacts/L1?state=1"/>'
+            '<output limsid="L1R" output-type="ResultFile" uri="{url}/artifacts/L1R?state=2"/>'
+            '</input-output-map></prc:process>')
+        lanes = []
+        for id, q30 in (('L1', 70), ('L2', 80)):
+            lanes.append(_entity(self.lims, Artifact, id,
+                '<art:artifact xmlns:art="http://genologics.com/ri/artifact" '
+                'xmlns:udf="http://genologics.com/ri/userdefined">'
+                '<name>' + id + '</name><type>Analyte</type>'
+                '<location><container uri="{url}/containers/FC"/><value>1:1</value></location>'
+                '<sample uri="{url}/samples/S1"/>'
+                '<udf:field type="Numeric" name="Q30">' + str(q30) + '</udf:field>'
+                '</art:artifact>'))
+        self.mirror.store_changes({Project: [project], Sample: [sample],
+                                   Process: [process], Artifact: lanes})
+        self.process = process
+
+    def tearDown(self):
+        self.mirror.close()
+
+    def test_find_udf(self):
+        lanes = self.mirror.find(Artifact, projectname='P', udf={'Q30': ('<', 75)})
+        assert_equal([a.id for a in lanes], ['L1'])
+        lanes = self.mirror.find(Artifact, projectname='P', udf={'Q30': ('>=', 70)})
+        assert_equal(sorted(a.id for a in lanes), ['L1', 'L2'])
+        assert_equal(self.mirror.find(Artifact, projectname='Other'), [])
+        assert_raises(ValueError, self.mirror.find, Artifact, udf={'Q30': ('LIKE', 1)})
+
+    def test_find_fields(self):
+        assert_equal([p.id for p in self.mirror.find(Process, process_type='Sequencing')], ['SEQ'])
+        assert_equal([s.id for s in self.mirror.find(Sample, projectname='P')], ['S1'])
+        assert_equal([p.id for p in self.mirror.find(Project, since='2014-12-31')], ['P1'])
+
+    def test_relations(self):
+        assert_equal([a.id for a in self.mirror.inputs(self.process)], ['L1'])
+        lane = self.mirror.get(url + '/artifacts/L1')
+        assert_equal([p.id for p in self.mirror.child_processes(lane)], ['SEQ'])
+        assert_equal(lane.name, 'L1')
+
+    def test_offline_instances(self):
+        lims = Lims('http://testgenologics.com:4040', username='test', password='password')
+        mirror = Mirror(lims)
+        mirror.connection = self.mirror.connection
+        lane = mirror.get(url + '/artifacts/L2')
+        assert_equal(lane.udf['Q30'], 80)
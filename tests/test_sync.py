@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from nose.tools import assert_equal, assert_true
+import json
+import os
+
+from genologics.entities import (Lab, Researcher, Project, Sample, Container,
+                                 Process, Artifact)
+from genologics.limiter import Limiter
+from genologics.lims import Lims
+from genologics.sync import DeltaSync
+from fake_server import FakeServer
+
+url = 'http://testgenologics.com:4040'
+tmp_dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'nose_tmp_output')
+
+
+class TestDeltaSync(object):
+    def setUp(self):
+        self.lims = Lims(url, username='test', password='password')
+        self.server = FakeServer(self.lims)
+        self.path = os.path.join(tmp_dir_path, 'sync_state.json')
+        if not os.path.isdir(tmp_dir_path):
+            os.mkdir(tmp_dir_path)
+        self.queries = []
+        # Entities modified since any last_modified, by listing
+        self.modified = dict()
+        art = lambda id, state: self.lims.get_uri('artifacts', id) + '?state=%i' % state
+        self.uris = dict(
+            labs=[self.server.add(Lab, 'L1', '<lab:lab xmlns:lab="http://genologics.com/ri/lab" uri="{uri}"><name>Lab</name></lab:lab>')],
+            researchers=[self.server.add(Researcher, 'R1', '<res:researcher xmlns:res="http://genologics.com/ri/researcher" uri="{uri}"/>')],
+            projects=[self.server.add(Project, 'P1', '<prj:project xmlns:prj="http://genologics.com/ri/project" uri="{uri}" limsid="{id}"><name>P1</name></prj:project>')],
+            containers=[self.server.add(Container, 'C1',
+                '<con:container xmlns:con="http://genologics.com/ri/container" uri="{uri}" limsid="{id}">'
+                '<placement uri="%s" limsid="A2"><value>A:1</value></placement></con:container>' % art('A2', 2))],
+            processes=[self.server.add(Process, 'PR1',
+                '<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{uri}" limsid="{id}">'
+                '<input-output-map><input limsid="A1" uri="%s"/>'
+                '<output limsid="A2" output-type="Analyte" uri="%s"/></input-output-map></prc:process>'
+                % (art('A1', 1), art('A2', 1)))])
+        for id, sample in (('A1', 'S1'), ('A2', 'S1'), ('A3', 'S2')):
+            self.server.add(Artifact, id,
+                '<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{uri}" limsid="{id}">'
+                '<sample uri="%s" limsid="%s"/></art:artifact>' % (self.lims.get_uri('samples', sample), sample))
+        for id in ('S1', 'S2', 'S3'):
+            self.server.add(Sample, id, '<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{uri}" limsid="{id}"/>')
+        for segment in self.uris:
+            self.server.listings[segment] = self._listing(segment)
+        self.server.listings['samples'] = lambda query: \
+            [self.lims.get_uri('samples', 'S3')] if query.get('projectlimsid') == ['P1'] else []
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _listing(self, segment):
+        def listing(query):
+            self.queries.append((segment, query.get('last-modified', [None])[0]))
+            if 'last-modified' in query:
+                return self.modified.get(segment, [])
+            return self.uris[segment]
+        return listing
+
+    def _fetched(self, segment):
+        return set(u.split('/')[-1] for u in self.server.calls_to('GET', segment) if '?' not in u)
+
+    def test_full(self):
+        changed = DeltaSync(self.lims).sync()
+        assert_equal(sorted(a.id for a in changed[Artifact]), ['A1', 'A2'])
+        assert_equal(sorted(s.id for s in changed[Sample]), ['S1', 'S3'])
+        assert_equal([c.id for c in changed[Container]], ['C1'])
+        # A2 is both a process output and placed, under two states
+        assert_equal([sorted(b) for b in self.server.batches if 'artifacts' in b[0]],
+                     [[self.lims.get_uri('artifacts', 'A1'), self.lims.get_uri('artifacts', 'A2')]])
+
+    def test_delta(self):
+        self.modified['processes'] = self.uris['processes']
+        changed = DeltaSync(self.lims, since='2015-01-01T00:00:00Z').sync()
+        assert_equal([p.id for p in changed[Process]], ['PR1'])
+        for klass in (Lab, Researcher, Project, Container):
+            assert_equal(changed[klass], [])
+        assert_equal(self._fetched('processes'), set(['PR1']))
+        assert_equal(self._fetched('labs'), set())
+        assert_equal(self._fetched('projects'), set())
+        assert_equal(sorted(a.id for a in changed[Artifact]), ['A1', 'A2'])
+        assert_equal(sorted(s.id for s in changed[Sample]), ['S1'])
+        assert_true(all(q == '2015-01-01T00:00:00Z' for segment, q in self.queries))
+
+    def test_state_file(self):
+        sync = DeltaSync(self.lims, state_file=self.path)
+        assert_equal(sync.since, None)
+        sync.sync()
+        with open(self.path) as infile:
+            since = json.load(infile)['since']
+        assert_equal(since, sync.since)
+        assert_true(since > '2015')
+        self.queries = []
+        DeltaSync(self.lims, since='2000-01-01T00:00:00Z', state_file=self.path).sync()
+        assert_true(self.queries)
+        assert_true(all(q == since for segment, q in self.queries))
+
+    def test_bulk(self):
+        priorities = []
+        acquire = self.lims.limiter.acquire
+        def record(priority, deadline=None):
+            priorities.append(priority)
+            return acquire(priority, deadline)
+        self.lims.limiter.acquire = record
+        DeltaSync(self.lims).sync()
+        assert_true(priorities)
+        assert_equal(set(priorities), set([Limiter.BULK]))